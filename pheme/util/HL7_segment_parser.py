@@ -2,12 +2,35 @@
 """
 Trivial parser to help with HL7 message debugging.
 """
+from array import array
+import bisect
+from collections import Counter, namedtuple, OrderedDict
+import cPickle
+import cProfile
+import copy
+import csv
 import glob
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
 from optparse import OptionParser
+import re
+import struct
 import sys
 import os.path
+import tempfile
+import time
+
+from pheme.util.compression import expand_file, open_compressed
+from pheme.util.compression import zip_protocol
 
 usage = """%prog [options] segment sequence[,sequence]* file[s]ToParse
+       %prog [options] --query segment:sequence[,sequence]*[:outfile] file[s]ToParse
+       %prog [options] --spec specfile file[s]ToParse
 
 This will echo to stdout all the matches found for the given parameters.
 Try `%prog --help` for additional information.
@@ -19,23 +42,1716 @@ Try `%prog --help` for additional information.
                    different from all other segments, as the field separator
                    '|' counts as sequence one.
   file[s]ToParse   one or more files to parse for matches; glob pattern
-                   support included
+                   support included.  gzip and zip compressed files
+                   are expanded on the fly
+
+Any number of segment / sequence queries may be run in a single pass
+using --query, repeated as needed, or --spec.  Each line of a spec
+file holds a query as 'segment sequence[,sequence]* [outfile]';
+blank lines and lines starting with '#' are ignored.  Queries without
+an outfile write to stdout.
+
+Messages may be restricted with --where, i.e. --where MSH-9=ADT^A04.
+Each filter is decided by the first segment of its type in a message;
+once a message fails a filter the rest of it is skipped, and messages
+without a segment of the filtered type are dropped.
+
+The default text output joins the sequences with '|' and prefixes any
+requested context with ':'.  With -f, the start of each file is noted
+with a 'READING FILE:' line, except where the matches of several files
+may interleave (--jobs without --ordered, and --sort-by-time), in
+which case each match is prefixed with its file.  --format tsv, csv
+or jsonl instead write one row per match with named columns: file,
+visit_id, patient_class, adt and time (as requested) followed by a
+column per sequence.
+
+--carry adds a value from an earlier segment of the same message to
+the context of each match, i.e. --carry OBR-4 --carry PID-3.1 OBX 3,5
+tags each result with its order and the patient.  The most recent
+segment of the type carried is used, so repeated groups such as
+OBR/OBX pair up.  The -a, -t, -v and -p flags are shorthand for
+carrying MSH-9, MSH-7, PID-18 and PV1-2.1.
+
+--count replaces the matches with a summary, counting each distinct
+match much like `sort | uniq -c`.  --group-by adds values from
+elsewhere in the message to what is counted, i.e. --group-by MSH-7:8
+counts per day.  Field references take the form
+segment-sequence[.component][:width], width keeping only that many
+leading characters.
+
+With --checkpoint, the byte offset reached in each file is saved, and
+the next run only scans what has since been appended.  --follow keeps
+watching the files (re-expanding any glob patterns), scanning newly
+appended messages every --interval seconds.  A message is complete
+once another message follows it, or once the file ends with a segment
+terminator and hasn't been modified for --interval seconds.
+
+With --manifest, each file's size, modification time and content
+hash are recorded, and its matches saved in a file named by the hash
+in the directory alongside (manifest.matches).  Later runs only scan
+new or changed files, replaying the recorded matches for the rest.
+The manifest is discarded if the queries, filters, context requested
+or --max-segment change.
+
+--dedup suppresses messages repeating the control id (MSH-10) of one
+already seen, as feeds replayed after an outage do.  Ids are tracked
+exactly up to a limit, and beyond it by a Bloom filter, which may
+drop a unique message with a probability of about one in ten
+thousand.  The filter starts out sized for --dedup-capacity ids and
+grows as more are seen.
+
+--copy loads the matches straight into PostgreSQL tables, one per
+query named by its outfile, i.e. --copy warehouse -q PV1:2,3:visits.
+The table's columns must match the output columns in order.  The
+database connection settings come from the named section of the
+config file.
+
+--since and --until restrict the scan to messages within a time
+window, comparing MSH-7 with as many leading digits as given, i.e.
+--since 20130101 --until 201301311200.  The earliest and latest
+message time of each file are kept in a sidecar (filename.times), so
+files entirely outside the window are skipped without being read.
+Files whose sidecar can't be written are scanned in full.  Glob
+patterns never match the sidecars themselves.
+
+--sort-by-time writes the matches in message time (MSH-7) order
+across all the files, rather than file by file, i.e. for feeds split
+over several interface engines.  Each file is expected to be in time
+order itself; the files are merged as they are read, holding only
+the next message of each in memory.
+
+--max-segment truncates any field longer than the given number of
+bytes as it is read, i.e. the OBX-5 of segments carrying whole
+documents as base64 (ED) data, so no more than that of a field is
+ever held in memory.  The fields following an oversized one, such as
+OBX-11 and OBX-14, are kept whole.  --memory-limit
+bounds the memory used by --count and --group-by, spilling the
+distinct matches counted to sorted temporary files once they take
+roughly the given number of megabytes, and merging them to write
+the counts.
+
+--shard splits the output over files named by a template holding
+field references, i.e. --shard 'out/{MSH-7:8}/{MSH-9.1}.tsv.gz'
+writes a file per day and message type.  Like the context, the
+values are taken from the most recent segment of their type.  Any
+query outfile holding field references is taken as a template, so
+queries may be sharded differently.  Files named with a '.gz' suffix
+are gzip compressed.  At most --max-open-shards files are kept open,
+one not recently written being closed (and later appended to) to
+make room.
+
+--mmap memory maps the input, searching it for the segments of
+interest rather than splitting every segment.  On Python 2 this is
+slower than the default reader, by a third or more even for messages
+carrying large payloads, and the mapped pages add to the resident
+size, so it is only worth trying where the reads themselves are the
+bottleneck.  --index reads only the segments of interest, seeking to
+them via a sidecar listing where each segment type is.
+
+--stats reports the volume scanned and where the time went to stderr.
+--profile runs the scan under cProfile, saving the profile to a file
+for inspection with pstats.
 """
 
+#: Number of bytes read at a time by `iter_segments`
+CHUNK_SIZE = 1 << 20
+
+#: Files larger than this are split at message boundaries for --jobs
+SPLIT_SIZE = 64 << 20
+
+#: Appended to an input filename to name its segment index sidecar
+INDEX_SUFFIX = '.idx'
+
+#: First line of every segment index sidecar
+INDEX_HEADER = '# HL7 segment index v2'
+
+#: Appended to the --manifest filename to name the directory holding
+#: the matches recorded for each file
+MATCHES_SUFFIX = '.matches'
+
+#: Appended to an input filename to name its time range sidecar
+TIMES_SUFFIX = '.times'
+
+#: First line of every time range sidecar
+TIMES_HEADER = '# HL7 time range v1'
+
+#: Suffixes of the sidecars written next to input files, which glob
+#: patterns never take as input
+SIDECAR_SUFFIXES = (INDEX_SUFFIX, TIMES_SUFFIX)
+
+#: Output is collected and written in blocks of roughly this many bytes
+BUFFER_SIZE = 1 << 20
+
+#: Matches loaded by --copy are sent and committed in batches of
+#: roughly this many bytes
+COPY_BATCH_SIZE = 16 << 20
+
+#: Table names accepted by --copy, optionally schema qualified
+TABLE_NAME = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*)?$')
+
+#: Most shard files written by --shard that are kept open at once
+MAX_OPEN_SHARDS = 64
+
+#: Output to each open shard file is collected and written in blocks
+#: of roughly this many bytes
+SHARD_BUFFER_SIZE = 256 << 10
+
+#: Matches the {FIELD} references of a shard template
+SHARD_FIELD = re.compile(r'\{([^{}]+)\}')
+
+#: Characters replaced in the values naming a shard file
+SHARD_UNSAFE = re.compile(r'[/\\\x00-\x1f]')
+
+#: Encoding --format jsonl assumes for values that aren't valid UTF-8,
+#: feeds often carrying latin-1 names
+FALLBACK_ENCODING = 'latin-1'
+
+#: Supported output formats, the first being the default
+FORMATS = ('text', 'tsv', 'csv', 'jsonl')
+
+#: Context columns of the legacy flags, and the fields they carry
+LEGACY_CONTEXT = (('visit_id', 'show_visitID', 'PID-18'),
+                  ('patient_class', 'show_pc', 'PV1-2.1'),
+                  ('adt', 'show_ADT', 'MSH-9'),
+                  ('time', 'show_time', 'MSH-7'))
+
+#: Number of control ids --dedup is sized for by default
+DEDUP_CAPACITY = 10000000
+
+#: False positive rate of the --dedup Bloom filter, however many ids
+DEDUP_ERROR_RATE = 0.0001
+
+#: Number of control ids --dedup also keeps exactly, confirming any
+#: Bloom filter hit
+EXACT_LIMIT = 1 << 20
+
+#: Estimated bytes of memory used by a counted key beyond its strings,
+#: for the tuples, dict entry and count holding it
+KEY_OVERHEAD = 200
+
+#: Matches any of the segment terminators understood by `iter_segments`
+TERMINATOR = re.compile(r'\r|\n|\\r')
+
+Delimiters = namedtuple('Delimiters', ('field', 'component', 'repetition',
+                                       'escape', 'subcomponent'))
+
+#: What `Parser.scan` needs of the queries, filters and context,
+#: as prepared once by `Parser.scan_plan`
+ScanPlan = namedtuple('ScanPlan', ('queries', 'filters', 'captures',
+                                   'splits', 'width'))
+
+#: The delimiters recommended by the standard, '|^~\\&'
+STANDARD_DELIMITERS = Delimiters('|', '^', '~', '\\', '&')
+
+_STANDARD_ENCODING = (STANDARD_DELIMITERS.field +
+                      ''.join(STANDARD_DELIMITERS[1:]) +
+                      STANDARD_DELIMITERS.field)
+
+_delimiters_cache = {STANDARD_DELIMITERS.field +
+                     ''.join(STANDARD_DELIMITERS[1:]): STANDARD_DELIMITERS}
+
+
+def delimiters(msh):
+    """Returns the Delimiters declared by an MSH segment
+
+    :param msh: the raw MSH segment of a message
+
+    MSH-1 (the character following 'MSH') is the field separator and
+    MSH-2 holds the component, repetition, escape and subcomponent
+    characters, in that order.  Any missing from MSH-2 fall back to
+    the standard characters.  Messages sharing a set of delimiters
+    share the returned instance.
+
+    """
+    if msh[3:9] == _STANDARD_ENCODING:
+        # the common case, spared the split and lookup
+        return STANDARD_DELIMITERS
+    field = msh[3:4] or STANDARD_DELIMITERS.field
+    encoding = msh[4:].split(field, 1)[0][:4]
+    key = field + encoding
+    if key not in _delimiters_cache:
+        _delimiters_cache[key] = Delimiters(
+            field, *(encoding + ''.join(STANDARD_DELIMITERS[1:])
+                     [len(encoding):]))
+    return _delimiters_cache[key]
+
+
+def truncate_fields(segment, field, max_field):
+    """Returns segment with any field longer than max_field truncated
+
+    :param segment: the raw segment, or the start of one
+    :param field: the field separator declared by its message
+    :param max_field: the most bytes of a field to keep
+
+    Every field separator is kept, so later fields keep their place.
+    As a truncated field is left exactly max_field long, truncating
+    the start of a segment, appending the rest and truncating again
+    gives the same as truncating the whole, so a long segment can be
+    read a piece at a time.
+
+    """
+    return field.join([value[:max_field]
+                       for value in segment.split(field)])
+
+
+def _read_truncated(read, length, field, max_field):
+    """Returns length bytes from read, as `truncate_fields`, reading
+    a chunk at a time so an oversized field is never held whole"""
+    segment = ''
+    while length > 0:
+        chunk = read(min(length, CHUNK_SIZE))
+        if not chunk:
+            break
+        length -= len(chunk)
+        segment = truncate_fields(segment + chunk, field, max_field)
+    return segment
+
+
+def iter_segments(fileobj, chunk_size=CHUNK_SIZE, segment_types=None,
+                  max_segment=None):
+    """Generate the segments found in fileobj, one at a time
+
+    :param fileobj: file like object containing HL7 messages
+    :param chunk_size: number of bytes to read at a time
+    :param segment_types: if given, only segments of these types are
+      generated, the rest being dropped a chunk at a time
+    :param max_segment: if given, fields are truncated to this many
+      bytes, see `truncate_fields`; the rest of a longer field is
+      dropped as it is read, so is never held in memory
+
+    By default, the files don't contain newlines and segments are
+    terminated by a carriage return.  Occasionally we have a newline
+    type file from a direct SQL query or the like, or one holding the
+    literal two character sequence backslash 'r'.  All three are
+    treated as segment terminators, normalized a chunk at a time so
+    only the current chunk and any partial segment carried over from
+    the previous one are held in memory.
+
+    """
+    pending = ''
+    # the field separator of the current message, for max_segment
+    field = STANDARD_DELIMITERS.field
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        raw = pending + chunk
+        # a trailing backslash may be the first half of a literal '\\r'
+        held = ''
+        if raw.endswith('\\'):
+            raw, held = raw[:-1], '\\'
+        raw = raw.replace('\n', '\r').replace('\\r', '\r')
+        segments = raw.split('\r')
+        pending = segments.pop()
+        if max_segment:
+            for position, segment in enumerate(segments):
+                if segment[0:3] == 'MSH':
+                    field = segment[3:4] or field
+                if len(segment) > max_segment:
+                    segments[position] = truncate_fields(
+                        segment, field, max_segment)
+            if pending[0:3] == 'MSH':
+                field = pending[3:4] or field
+            if len(pending) > max_segment:
+                # held out of the truncation, so a literal '\\r'
+                # split across chunks still ends the segment
+                pending = truncate_fields(pending, field, max_segment)
+        pending += held
+        if segment_types is not None:
+            segments = [segment for segment in segments
+                        if segment[0:3] in segment_types]
+        for segment in segments:
+            if segment:
+                yield segment
+    if pending and (segment_types is None or
+                    pending[0:3] in segment_types):
+        yield pending
+
+
+def iter_segment_offsets(fileobj, chunk_size=CHUNK_SIZE):
+    """Generate (offset, length, segment type) for every segment
+
+    :param fileobj: file like object containing HL7 messages
+    :param chunk_size: number of bytes to read at a time
+
+    The byte offset and length of each segment is reported rather
+    than the segment itself.  The same terminators as `iter_segments`
+    are recognized.
+
+    """
+    offset, pending = 0, ''
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        raw = pending + chunk
+        # a trailing backslash may be the first half of a literal '\\r'
+        stop = len(raw) - 1 if raw.endswith('\\') else len(raw)
+        start = 0
+        for match in TERMINATOR.finditer(raw, 0, stop):
+            if match.start() > start:
+                yield (offset + start, match.start() - start,
+                       raw[start:start + 3])
+            start = match.end()
+        offset += start
+        pending = raw[start:]
+    if pending:
+        yield offset, len(pending), pending[:3]
+
+
+def index_filename(filename):
+    """Returns the name of the segment index sidecar for filename"""
+    return filename + INDEX_SUFFIX
+
+
+def build_index(filename):
+    """Write the segment index sidecar for filename
+
+    The sidecar records the size and modification time of filename
+    (and the item size of the arrays), followed by a 'type count'
+    line per segment type.  Each such line is followed by the byte
+    offsets of the count segments of that type, then their lengths,
+    written as binary `array('L')`s.  As every message begins with an
+    MSH segment, the MSH offsets double as the list of message
+    starts.  The sidecar is written to a temporary file and renamed
+    into place, so readers never see a partial index.  As with
+    `build_time_range`, the sidecar is opened before filename is
+    read, so an IOError is raised straight away should it not be
+    writable.
+
+    """
+    indexname = index_filename(filename)
+    index = open(indexname + '.tmp', 'wb')
+    try:
+        with index:
+            offsets, lengths = {}, {}
+            with open(filename, 'rb') as FILE:
+                stat = os.fstat(FILE.fileno())
+                for offset, length, segment_type in \
+                        iter_segment_offsets(FILE):
+                    if segment_type not in offsets:
+                        offsets[segment_type] = array('L')
+                        lengths[segment_type] = array('L')
+                    offsets[segment_type].append(offset)
+                    lengths[segment_type].append(length)
+            index.write('%s\n%s\n' % (INDEX_HEADER, _index_stamp(stat)))
+            for segment_type in sorted(offsets):
+                index.write('%s %d\n' % (segment_type,
+                                         len(offsets[segment_type])))
+                offsets[segment_type].tofile(index)
+                lengths[segment_type].tofile(index)
+    except Exception:
+        os.remove(indexname + '.tmp')
+        raise
+    os.rename(indexname + '.tmp', indexname)
+
+
+def _index_stamp(stat):
+    """Returns the line identifying what an index was built from"""
+    return '%d %r %d' % (stat.st_size, stat.st_mtime, array('L').itemsize)
+
+
+def load_index(filename, segment_types):
+    """Returns the indexed offsets for the requested segment types
+
+    :param filename: the indexed file, not the sidecar itself
+    :param segment_types: the segment types of interest
+
+    Returns a dictionary keyed by segment type, of (offsets, lengths)
+    pairs of `array('L')`s in file order, so taking a few bytes per
+    segment.  A sidecar that is missing, or no longer matches the
+    size and modification time of filename, is (re)built first.  Only
+    the arrays for the requested segment types are read, the rest
+    being skipped over.
+
+    """
+    stat = os.stat(filename)
+    expected = [INDEX_HEADER, _index_stamp(stat)]
+    indexname = index_filename(filename)
+    current = False
+    if os.path.exists(indexname):
+        with open(indexname, 'rb') as index:
+            current = [index.readline().rstrip('\n')
+                       for line in expected] == expected
+    if not current:
+        build_index(filename)
+
+    found = dict((segment_type, (array('L'), array('L')))
+                 for segment_type in segment_types)
+    itemsize = array('L').itemsize
+    with open(indexname, 'rb') as index:
+        for line in expected:
+            index.readline()
+        for line in iter(index.readline, ''):
+            segment_type, count = line.split()
+            count = int(count)
+            if segment_type in found:
+                offsets, lengths = found[segment_type]
+                offsets.fromfile(index, count)
+                lengths.fromfile(index, count)
+            else:
+                index.seek(2 * count * itemsize, os.SEEK_CUR)
+    return found
+
+
+def iter_indexed_segments(fileobj, index, start=0, end=None,
+                          max_segment=None):
+    """Generate the indexed segments of fileobj, in file order
+
+    :param fileobj: open, uncompressed file the index describes
+    :param index: dictionary of (offsets, lengths) arrays, as
+      returned from `load_index`
+    :param start: byte offset from which to begin
+    :param end: byte offset at which to stop, defaults to end of file
+    :param max_segment: if given, fields are truncated to this many
+      bytes as they are read, see `truncate_fields`
+
+    Seeks directly to each indexed segment, leaving the remainder of
+    the file unread.
+
+    """
+    field = STANDARD_DELIMITERS.field
+    pairs = []
+    for offsets, lengths in index.values():
+        first = bisect.bisect_left(offsets, start)
+        pairs.append(itertools.izip(itertools.islice(offsets, first, None),
+                                    itertools.islice(lengths, first, None)))
+    for offset, length in heapq.merge(*pairs):
+        if end is not None and offset >= end:
+            break
+        fileobj.seek(offset)
+        if not max_segment or length <= max_segment:
+            segment = fileobj.read(length)
+        else:
+            segment = _read_truncated(fileobj.read, length, field,
+                                      max_segment)
+        if max_segment and segment[0:3] == 'MSH':
+            field = segment[3:4] or field
+        yield segment
+
+
+def times_filename(filename):
+    """Returns the name of the time range sidecar for filename"""
+    return filename + TIMES_SUFFIX
+
+
+def is_sidecar(filename):
+    """Returns True if filename is one of the sidecars written next
+    to the input files, so never input itself"""
+    for suffix in SIDECAR_SUFFIXES:
+        if filename.endswith(suffix) or filename.endswith(suffix + '.tmp'):
+            return True
+    return False
+
+
+def build_time_range(filename):
+    """Write the time range sidecar for filename, returns the range
+
+    The sidecar records the size and modification time of filename,
+    then the earliest and latest MSH-7 of its messages, compared as
+    strings, on a line each.  Returns the (earliest, latest) tuple,
+    (None, None) if filename holds no messages.  The sidecar is
+    opened before filename is read, so an IOError is raised straight
+    away should it not be writable.
+
+    """
+    timesname = times_filename(filename)
+    times = open(timesname + '.tmp', 'wb')
+    try:
+        with times:
+            earliest, latest, stat = _time_range(filename)
+            times.write('%s\n%d %r\n' % (TIMES_HEADER, stat.st_size,
+                                          stat.st_mtime))
+            if earliest is not None:
+                times.write('%s\n%s\n' % (earliest, latest))
+    except Exception:
+        os.remove(timesname + '.tmp')
+        raise
+    os.rename(timesname + '.tmp', timesname)
+    return earliest, latest
+
+
+def _time_range(filename):
+    """Returns the earliest and latest MSH-7 in filename, and its
+    stat from when it was opened"""
+    earliest = latest = None
+    with open_input(filename) as FILE:
+        stat = os.stat(filename)
+        if isinstance(FILE, file):
+            segments = iter_mapped_segments(FILE, ('MSH',))
+        else:
+            segments = iter_segments(FILE)
+        for segment in segments:
+            if 'MSH' != segment[0:3]:
+                continue
+            fields = segment.split(delimiters(segment).field, 7)
+            when = fields[6] if len(fields) > 6 else ''
+            if earliest is None or when < earliest:
+                earliest = when
+            if latest is None or when > latest:
+                latest = when
+    return earliest, latest, stat
+
+
+def load_time_range(filename):
+    """Returns the (earliest, latest) MSH-7 of the messages in filename
+
+    Read from the sidecar, which is (re)built first if missing or no
+    longer matching the size and modification time of filename.  See
+    `build_time_range`.
+
+    """
+    stat = os.stat(filename)
+    expected = [TIMES_HEADER, '%d %r' % (stat.st_size, stat.st_mtime)]
+    timesname = times_filename(filename)
+    if os.path.exists(timesname):
+        with open(timesname, 'rb') as times:
+            lines = [line.rstrip('\n') for line in times]
+        if lines[:2] == expected:
+            if len(lines) < 4:
+                return None, None
+            return lines[2], lines[3]
+    return build_time_range(filename)
+
+
+def open_input(filename):
+    """Open filename for reading, expanding compressed content
+
+    gzip and zip files, recognized by their magic bytes, are expanded
+    as a stream via `compression.expand_file` - nothing is written to
+    disk.  Other files are opened as is.
+
+    """
+    protocol = zip_protocol(filename)
+    if protocol:
+        return expand_file(filename=filename, zip_protocol=protocol)
+    return open(filename, 'rb')
+
+
+def message_boundary(fileobj, offset, chunk_size=CHUNK_SIZE):
+    """Returns the offset of the first message starting at or after offset
+
+    :param fileobj: seekable file like object containing HL7 messages
+    :param offset: byte offset from which to start looking
+    :param chunk_size: number of bytes to read at a time
+
+    A message starts with an 'MSH' at the beginning of the file or
+    immediately following any of the segment terminators understood
+    by `iter_segments`, whatever field delimiter it declares.
+    Returns None if no message starts at or after offset.
+
+    """
+    if offset <= 0:
+        return 0
+    # back up two bytes so the terminator preceding offset is visible
+    window_offset = max(offset - 2, 0)
+    fileobj.seek(window_offset)
+    window = ''
+    search_from = offset - window_offset
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return None
+        window += chunk
+        found = window.find('MSH', search_from)
+        while found >= 0:
+            position = window_offset + found
+            if (position == 0 or window[found - 1] in '\r\n' or
+                    window[found - 2:found] == '\\r'):
+                return position
+            found = window.find('MSH', found + 1)
+        # retain enough of the tail to match an 'MSH' spanning
+        # chunks, along with the two bytes that may precede it
+        search_from = max(search_from, len(window) - 2)
+        cut = max(search_from - 2, 0)
+        window_offset += cut
+        window = window[cut:]
+        search_from -= cut
+
+
+def _is_segment_start(mapped, position):
+    """Returns True if position is at the start of the map or
+    immediately follows a segment terminator"""
+    return (position == 0 or mapped[position - 1] in '\r\n' or
+            mapped[position - 2:position] == '\\r')
+
+
+def last_message_boundary(fileobj, start, end):
+    """Returns the offset of the last message starting in [start, end)
+
+    :param fileobj: open, uncompressed file containing HL7 messages
+    :param start: byte offset from which to look
+    :param end: byte offset up to which to look
+
+    Searches backwards from end via a memory map for an 'MSH' at a
+    segment start, as `message_boundary` does.  Returns None if no
+    message starts in the range.
+
+    """
+    if end <= start:
+        return None
+    mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        found = mapped.rfind('MSH', start, end + 2)
+        while found >= 0:
+            if _is_segment_start(mapped, found):
+                return found
+            found = mapped.rfind('MSH', start, found + 2)
+        return None
+    finally:
+        mapped.close()
+
+
+def appended_range(filename, checkpointed, interval):
+    """Returns the (start, end, inode) of the complete messages
+    appended to filename since checkpointed, None if there are none
+
+    :param filename: the file being followed
+    :param checkpointed: the (offset, inode) reached before, (0, None)
+      for a file not seen before
+    :param interval: seconds filename must go unmodified before its
+      last message is taken as complete
+
+    Starts over from the beginning of a file that was truncated or
+    replaced (has a new inode).  The last message is complete once the
+    file ends with a segment terminator and has been quiet for
+    interval, otherwise it may still be being written, so the range
+    ends where it starts.  Compressed files can only be read whole,
+    so are given the range of the whole file, again only if they
+    change.
+
+    """
+    stat = os.stat(filename)
+    offset, inode = checkpointed
+    if (offset, inode) == (stat.st_size, stat.st_ino):
+        return None
+    compressed = zip_protocol(filename)
+    if compressed or inode != stat.st_ino or stat.st_size < offset:
+        offset = 0
+
+    end = stat.st_size
+    if not compressed:
+        with open(filename, 'rb') as FILE:
+            FILE.seek(max(end - 2, 0))
+            tail = FILE.read(2)
+            quiet = ((tail[-1:] in ('\r', '\n') or tail == '\\r') and
+                     time.time() - stat.st_mtime >= interval)
+            if not quiet:
+                end = last_message_boundary(FILE, offset + 1, end)
+        if end is None:
+            return None
+    return offset, end, stat.st_ino
+
+
+def load_checkpoint(filename):
+    """Returns the checkpointed {filename: (offset, inode)} dictionary
+
+    An empty dictionary is returned if the checkpoint file doesn't
+    exist yet.
+
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as checkpoint:
+        return dict((k, tuple(v)) for k, v in json.load(checkpoint).items())
+
+
+def save_checkpoint(filename, offsets):
+    """Save the {filename: (offset, inode)} dictionary to filename
+
+    Written to a temporary file and renamed into place, so a run
+    interrupted mid write leaves the previous checkpoint intact.
+
+    """
+    with open(filename + '.tmp', 'w') as checkpoint:
+        json.dump(offsets, checkpoint)
+    os.rename(filename + '.tmp', filename)
+
+
+def file_hash(filename, chunk_size=CHUNK_SIZE):
+    """Returns the hex SHA-1 digest of the (unexpanded) file contents"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as FILE:
+        for chunk in iter(lambda: FILE.read(chunk_size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(filename, key):
+    """Returns the manifest's {filename: entry} dictionary
+
+    :param filename: the manifest file
+    :param key: the `Parser.manifest_key` the entries must have been
+      recorded with
+
+    Each entry is a dictionary holding the size, mtime and hash of
+    the file when scanned; the matches found are kept apart, see
+    `matches_filename`.  An empty dictionary is returned if the
+    manifest doesn't exist yet, or was recorded with a different key.
+
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'rb') as manifest:
+        recorded = cPickle.load(manifest)
+    if recorded['key'] != key:
+        return {}
+    return recorded['files']
+
+
+def save_manifest(filename, key, entries):
+    """Save the {filename: entry} dictionary to the manifest filename
+
+    Written to a temporary file and renamed into place, like
+    `save_checkpoint`.  Any recorded matches no longer referenced by
+    an entry are then removed.
+
+    """
+    with open(filename + '.tmp', 'wb') as manifest:
+        cPickle.dump({'key': key, 'files': entries}, manifest,
+                     cPickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
+    directory = filename + MATCHES_SUFFIX
+    if os.path.isdir(directory):
+        digests = set(entry['hash'] for entry in entries.values())
+        for name in os.listdir(directory):
+            if name not in digests:
+                os.remove(os.path.join(directory, name))
+
+
+def matches_filename(manifest, digest):
+    """Returns the file recording the matches of files whose content
+    hash is digest, in the directory alongside the manifest"""
+    return os.path.join(manifest + MATCHES_SUFFIX, digest)
+
+
+def save_matches(filename, matches):
+    """Record matches in filename, as they are generated
+
+    Pickled a match at a time rather than as JSON, as the matches are
+    raw bytes from the feed and needn't be valid in any encoding.
+    Written to a temporary file and renamed into place.
+
+    """
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename + '.tmp', 'wb') as recorded:
+        pickler = cPickle.Pickler(recorded, cPickle.HIGHEST_PROTOCOL)
+        for match in matches:
+            pickler.dump(match)
+            pickler.clear_memo()
+    os.rename(filename + '.tmp', filename)
+
+
+def load_matches(filename):
+    """Generate the matches recorded in filename by `save_matches`"""
+    with open(filename, 'rb') as recorded:
+        unpickler = cPickle.Unpickler(recorded)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                break
+
+
+def _segment_start(mapped, tag, start, end):
+    """Returns offset of the next segment beginning with tag, or None
+
+    Only occurrences of tag at the beginning of the map or immediately
+    following a segment terminator count.
+
+    """
+    found = mapped.find(tag, start, end)
+    while found >= 0:
+        if _is_segment_start(mapped, found):
+            return found
+        found = mapped.find(tag, found + 1, end)
+    return None
+
+
+def iter_mapped_segments(fileobj, segment_types, start=0, end=None,
+                         max_segment=None):
+    """Generate only the segments of the requested types, via mmap
+
+    :param fileobj: open, uncompressed file containing HL7 messages
+    :param segment_types: the segment types to generate, i.e. 'MSH'
+    :param start: byte offset from which to begin
+    :param end: byte offset at which to stop, defaults to end of file
+    :param max_segment: if given, fields are truncated to this many
+      bytes as they are copied out of the map, see `truncate_fields`
+
+    The file is memory mapped and segment starts are located with
+    `find`, working on offsets rather than splitting the file.  Only
+    segments of the requested types are copied out of the map, in
+    the order they appear.  The same terminators as `iter_segments`
+    are recognized.
+
+    Each requested segment (every message's MSH among them) costs a
+    Python step, where `iter_segments` splits a whole chunk in one
+    call, and under Python 2 `mmap.find` is a plain byte loop.  So
+    this is slower than `iter_segments`, by a third or more on a warm
+    cache, even where the requested types are a small part of the
+    bytes.  The mapped pages also count towards the process's
+    resident size.  `iter_indexed_segments` is the way to read only
+    the segments of interest.
+
+    """
+    size = os.fstat(fileobj.fileno()).st_size
+    if end is None:
+        end = size
+    if start >= end:
+        return
+    mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    find = mapped.find
+    try:
+        heap = []
+        for segment_type in set(segment_types):
+            # segment types are always three characters, so need no
+            # field separator to tell them apart
+            tag = segment_type
+            found = _segment_start(mapped, tag, start, end)
+            if found is not None:
+                heap.append((found, tag))
+        heapq.heapify(heap)
+        field = STANDARD_DELIMITERS.field
+        # the next of each terminator, so finding the end of every
+        # segment costs a single pass per terminator rather than a
+        # search from each segment start
+        cr = newline = literal = -1
+        while heap:
+            position, tag = heap[0]
+            if cr < position:
+                cr = find('\r', position, end)
+                if cr < 0:
+                    cr = end
+            if newline < position:
+                newline = find('\n', position, end)
+                if newline < 0:
+                    newline = end
+            if literal < position:
+                literal = find('\\r', position, end)
+                if literal < 0:
+                    literal = end
+            stop = cr
+            if newline < stop:
+                stop = newline
+            if literal < stop:
+                stop = literal
+            if max_segment and stop - position > max_segment:
+                mapped.seek(position)
+                yield _read_truncated(mapped.read, stop - position, field,
+                                      max_segment)
+            else:
+                yield mapped[position:stop]
+            if max_segment and 'MSH' == tag:
+                field = mapped[position + 3:position + 4] or field
+            found = find(tag, stop, end)
+            # mostly the very next occurrence starts a segment
+            if found >= 0 and mapped[found - 1] not in '\r\n':
+                found = _segment_start(mapped, tag, found, end)
+            elif found < 0:
+                found = None
+            if found is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (found, tag))
+    finally:
+        mapped.close()
+
+
+class FileRange(object):
+    """Read only access to the byte range [start, end) of a file"""
+
+    def __init__(self, fileobj, start, end):
+        fileobj.seek(start)
+        self.fileobj = fileobj
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def _scan_job(job):
+    """Process pool entry point, see `Parser.parse_parallel`
+
+    :param job: tuple (parser, filename, start, end)
+
+    Returns the job's filename and start, along with the list of
+    (query index, context, values) matches for the byte range [start,
+    end) of the file and the job's Stats, if collected.  When
+    counting, the matches are tallied by the worker and a
+    `SpillingCounter` is returned in place of the list.  With dedup
+    set, a (message starts, matches) tuple from `_MessageLog` is
+    returned instead, as duplicates can only be decided by the
+    parent.
+
+    """
+    parser, filename, start, end = job
+    if parser.stats:
+        parser.stats = Stats()
+        begin = time.time()
+    with open_input(filename) as FILE:
+        matches = parser.matches(FILE, start, end)
+        if parser.dedup:
+            parser.seen = log = _MessageLog()
+            for match in matches:
+                log.found.append(match)
+            matches = (log.starts, log.found)
+        elif parser.count:
+            matches = parser.tally(filename, matches,
+                                   SpillingCounter(parser.memory_limit))
+        else:
+            matches = list(matches)
+    if parser.stats:
+        parser.stats.work_time += time.time() - begin
+    return filename, start, matches, parser.stats
+
+
+def parse_sequences(segment, sequences):
+    """Returns the list of split indices for the sequences of segment
+
+    :param segment: the segment type, i.e. 'PV1'
+    :param sequences: comma separated sequence numbers, i.e. '2,3'
+
+    MSH counts different from all other segments, as the field
+    separator counts as sequence one.  Raises ValueError on anything
+    but a comma separated list of integers.
+
+    """
+    indices = [int(num) for num in sequences.split(",")]
+    if 'MSH' == segment:
+        indices = [num - 1 for num in indices]
+    return indices
+
+
+class FieldRef(object):
+    """Reference to a field, or component of one, i.e. 'PV1-2.1'"""
+
+    def __init__(self, reference):
+        """Parse a 'segment-sequence[.component][:width]' reference
+
+        Sequences follow the same numbering as the command line, so
+        for MSH the field separator counts as sequence one.  A width
+        keeps only that many leading characters of the value, i.e.
+        'MSH-7:8' for the date of the message.  Raises ValueError if
+        reference looks incorrect.
+
+        """
+        try:
+            self.segment, rest = reference.split('-', 1)
+            rest, _, width = rest.partition(':')
+            sequence, _, component = rest.partition('.')
+            self.index = parse_sequences(self.segment, sequence)[0]
+            self.component = int(component) if component else 0
+            self.width = int(width) if width else None
+        except ValueError:
+            raise ValueError("field reference '%s' looks incorrect, "
+                             "expected something like 'PV1-2'" % reference)
+        if len(self.segment) != 3 or self.index < 0 or self.component < 0:
+            raise ValueError("field reference '%s' looks incorrect, "
+                             "expected something like 'PV1-2'" % reference)
+        self.reference = reference
+
+    def value(self, fields, component=STANDARD_DELIMITERS.component):
+        """Returns the referenced value from a segment's split fields,
+        or '' if not present
+
+        :param component: the message's component separator
+
+        """
+        if self.index >= len(fields):
+            return ''
+        value = fields[self.index]
+        if self.component:
+            components = value.split(component, self.component)
+            if self.component > len(components):
+                return ''
+            value = components[self.component - 1]
+        if self.width is not None:
+            value = value[:self.width]
+        return value
+
+
+class Filter(object):
+    """A test of a referenced field, i.e. 'PV1-2=E' or 'MSH-9!=ADT^A08'"""
+
+    def __init__(self, expression):
+        """Parse a 'reference=value' or 'reference!=value' expression
+
+        Raises ValueError if expression looks incorrect.
+
+        """
+        reference, operator, self.expected = expression.partition('=')
+        if not operator:
+            raise ValueError("filter '%s' looks incorrect, expected "
+                             "something like 'PV1-2=E'" % expression)
+        self.negate = reference.endswith('!')
+        self.field = FieldRef(reference.rstrip('!'))
+
+    def matches(self, fields, component=STANDARD_DELIMITERS.component):
+        """Returns True if the segment's split fields pass the test
+
+        :param component: the message's component separator
+
+        """
+        return ((self.field.value(fields, component) == self.expected) !=
+                self.negate)
+
+
+class SeenSet(object):
+    """Memory bounded record of the keys seen, for duplicate detection
+
+    Keys are added to a scalable Bloom filter, a series of filters
+    the first of which is sized for capacity keys.  Once the newest
+    filter holds as many keys as it was sized for, another is added,
+    twice as large and with half the error rate.  A key is seen if
+    any of the filters holds it, so the chance of wrongly reporting
+    a new key as seen stays below error_rate however many keys are
+    added, memory growing with their number.  Until exact_limit keys
+    have been seen, they are also kept in a set confirming each
+    filter hit, so answers are exact.
+
+    """
+
+    def __init__(self, capacity=DEDUP_CAPACITY, error_rate=DEDUP_ERROR_RATE,
+                 exact_limit=EXACT_LIMIT):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.slices = []
+        self.exact = set()
+        self.exact_limit = exact_limit
+        self.add_slice()
+
+    def add_slice(self):
+        """Start a new, larger filter once the newest is full"""
+        number = len(self.slices)
+        capacity = self.capacity << number
+        error_rate = self.error_rate / (2 << number)
+        size = int(math.ceil(-capacity * math.log(error_rate) /
+                             math.log(2) ** 2))
+        hashes = max(int(round(size * math.log(2) / capacity)), 1)
+        self.slices.append((size, hashes, bytearray((size + 7) // 8)))
+        self.remaining = capacity
+
+    def add(self, key):
+        """Add key, returns False if it had already been seen
+
+        Empty keys are never taken as seen.
+
+        """
+        if not key:
+            return True
+        first, second = struct.unpack('<QQ', hashlib.md5(key).digest())
+        hit = False
+        for size, hashes, bits in self.slices:
+            positions = [(first + i * second) % size
+                         for i in xrange(hashes)]
+            if all(bits[p >> 3] & (1 << (p & 7)) for p in positions):
+                hit = True
+                break
+        if hit and (self.exact is None or key in self.exact):
+            return False
+        # new keys go in the newest filter only
+        size, hashes, bits = self.slices[-1]
+        for i in xrange(hashes):
+            p = (first + i * second) % size
+            bits[p >> 3] |= 1 << (p & 7)
+        self.remaining -= 1
+        if not self.remaining:
+            self.add_slice()
+        if self.exact is not None:
+            self.exact.add(key)
+            if len(self.exact) > self.exact_limit:
+                self.exact = None
+        return True
+
+
+class _MessageLog(object):
+    """Stands in for a SeenSet in pool workers, noting each message's
+    control id and where its matches begin, for the parent to decide
+    upon with `Parser.unique_matches`"""
+
+    def __init__(self):
+        self.starts = []
+        self.found = []
+
+    def add(self, key):
+        self.starts.append((key, len(self.found)))
+        return True
+
+
+class SpillingCounter(object):
+    """Counter of hashable keys, spilling to disk beyond a memory limit
+
+    Keys are counted in a dict until their estimated size exceeds
+    limit bytes, at which point they are written out in sorted order
+    to a temporary file, a run, and the dict emptied.  The runs and
+    whatever remains in memory are merged as streams by
+    `sorted_items`, so memory use stays near the limit however many
+    distinct keys are counted.  Keys are the tuples of strings built
+    by `Parser.tally`.  Runs are named files, so a counter filled by a
+    pool worker can be returned to the parent, which must `close` it
+    once read.
+
+    """
+
+    def __init__(self, limit=None):
+        """:param limit: bytes of keys held in memory before spilling,
+          None for no limit"""
+        self.limit = limit
+        self.counts = Counter()
+        self.size = 0
+        self.runs = []
+
+    def key_size(self, key):
+        """Returns the estimated bytes of memory used by key"""
+        index, filename, context, values = key
+        return (KEY_OVERHEAD + len(filename or '') +
+                sum(len(value) for value in context) +
+                sum(len(value or '') for value in values))
+
+    def add(self, key, count=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+            return
+        counts[key] = count
+        if self.limit is not None:
+            self.size += self.key_size(key)
+            if self.size > self.limit:
+                self.spill()
+
+    def update(self, counts):
+        """Add the counts of a Counter, or another SpillingCounter"""
+        if isinstance(counts, SpillingCounter):
+            if counts.runs:
+                counts = counts.sorted_items()
+            else:
+                counts = counts.counts.iteritems()
+        else:
+            counts = counts.iteritems()
+        for key, count in counts:
+            self.add(key, count)
+
+    def spill(self):
+        """Write the keys held in memory to a new run"""
+        handle, name = tempfile.mkstemp(prefix='hl7_counts')
+        with os.fdopen(handle, 'wb') as run:
+            pickler = cPickle.Pickler(run, cPickle.HIGHEST_PROTOCOL)
+            for item in sorted(self.counts.iteritems()):
+                pickler.dump(item)
+                # the pickler would otherwise remember every key written
+                pickler.clear_memo()
+        self.runs.append(name)
+        self.counts = Counter()
+        self.size = 0
+
+    def _read_run(self, name):
+        """Generate the (key, count) items of a spilled run"""
+        with open(name, 'rb') as run:
+            unpickler = cPickle.Unpickler(run)
+            while True:
+                try:
+                    yield unpickler.load()
+                except EOFError:
+                    break
+
+    def sorted_items(self):
+        """Generate the (key, count) items in key order, summing the
+        counts of a key spilled more than once"""
+        merged = heapq.merge(sorted(self.counts.iteritems()),
+                             *[self._read_run(run) for run in self.runs])
+        current, total = None, 0
+        for key, count in merged:
+            if total and key == current:
+                total += count
+                continue
+            if total:
+                yield current, total
+            current, total = key, count
+        if total:
+            yield current, total
+
+    def close(self):
+        """Discard the spilled runs"""
+        for name in self.runs:
+            if os.path.exists(name):
+                os.remove(name)
+        self.runs = []
+
+
+class Query(object):
+    """A segment type, the sequences to display and where to put them"""
+
+    def __init__(self, segment, sequences, output=None):
+        """Create a query
+
+        :param segment: the segment type, i.e. 'PV1'
+        :param sequences: list of split indices to display, see
+          `parse_sequences`
+        :param output: name of the file to write matches to, or None
+          for stdout
+
+        """
+        self.segment = segment
+        self.sequences = sequences
+        self.output = output
+
+    def columns(self):
+        """Returns the column names for the sequences, i.e. 'PV1-2'"""
+        offset = 1 if 'MSH' == self.segment else 0
+        return ['%s-%d' % (self.segment, index + offset)
+                for index in self.sequences]
+
+
+class Stats(object):
+    """Statistics for a run, reported with --stats"""
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.messages = 0
+        self.segments = 0
+        self.matches = 0
+        self.read_time = 0.0
+        self.write_time = 0.0
+        self.work_time = 0.0
+
+    def add(self, other):
+        """Add the statistics collected by another (worker's) Stats"""
+        for name, value in vars(other).items():
+            setattr(self, name, getattr(self, name) + value)
+
+    def counted(self, segments):
+        """Pass segments through, counting them and the messages"""
+        for segment in segments:
+            self.segments += 1
+            if segment.startswith('MSH'):
+                self.messages += 1
+            yield segment
+
+    def matched(self, matches):
+        """Pass matches through, counting them"""
+        for match in matches:
+            self.matches += 1
+            yield match
+
+    def report(self, stream, elapsed, parallel=False):
+        """Write the statistics to stream
+
+        :param elapsed: wall clock seconds for the run
+        :param parallel: set if scanned by worker processes, in which
+          case the read and scan times are summed over the workers
+
+        Time spent waiting on the input, other than via a memory map,
+        counts as read time.  Time spent writing the output counts as
+        write time, with the remainder going to scanning.
+
+        """
+        if parallel:
+            scan_time = self.work_time - self.read_time
+            summed = ' (summed over workers)'
+        else:
+            scan_time = elapsed - self.read_time - self.write_time
+            summed = ''
+        elapsed = max(elapsed, 1e-6)
+        megabytes = self.bytes_read / float(1 << 20)
+        for label, value in (
+                ('bytes read', '%d (%.1f MB)' % (self.bytes_read,
+                                                 megabytes)),
+                ('messages', self.messages),
+                ('segments scanned', self.segments),
+                ('segments matched', self.matches),
+                ('read time', '%.3fs%s' % (self.read_time, summed)),
+                ('scan time', '%.3fs%s' % (scan_time, summed)),
+                ('write time', '%.3fs' % self.write_time),
+                ('elapsed', '%.3fs' % elapsed),
+                ('throughput', '%.1f MB/s, %d messages/s' % (
+                    megabytes / elapsed, self.messages / elapsed))):
+            stream.write('%-17s %s\n' % (label + ':', value))
+
+
+class ReadTimer(object):
+    """Wraps a file like object, adding its reads to a Stats"""
+
+    def __init__(self, fileobj, stats):
+        self.fileobj = fileobj
+        self.stats = stats
+
+    def read(self, size=-1):
+        begin = time.time()
+        data = self.fileobj.read(size)
+        self.stats.read_time += time.time() - begin
+        self.stats.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        self.fileobj.seek(offset, whence)
+
+
+class OutputBuffer(object):
+    """Collects output for a stream, writing it in large blocks
+
+    A plain file already buffers its writes, far more cheaply than a
+    list can, so is written to directly unless the time taken writing
+    is being collected in stats.
+
+    """
+
+    def __init__(self, stream, size=BUFFER_SIZE, stats=None):
+        self.stream = stream
+        self.size = size
+        self.stats = stats
+        self.pending = []
+        self.pending_size = 0
+        if isinstance(stream, file) and stats is None:
+            self.write = stream.write
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.size:
+            self.flush()
+
+    def flush(self):
+        begin = time.time()
+        self.stream.write(''.join(self.pending))
+        self.stream.flush()
+        self.pending, self.pending_size = [], 0
+        if self.stats:
+            self.stats.write_time += time.time() - begin
+
+    def close(self):
+        """Flush, and close the stream unless it is stdout"""
+        self.flush()
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+    def abort(self):
+        """Close after a failed run
+
+        A stream able to roll back, such as `pg_copy.CopyStream`,
+        discards the pending output and rolls back its open batch.
+        Any other is flushed and closed as usual.
+
+        """
+        rollback = getattr(self.stream, 'rollback', None)
+        if rollback is None:
+            self.close()
+            return
+        self.pending, self.pending_size = [], 0
+        rollback()
+
+
+def text_value(value):
+    """Returns value decoded as UTF-8, or as `FALLBACK_ENCODING`
+    where it isn't valid UTF-8; values other than strings are
+    returned as is"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode(FALLBACK_ENCODING)
+
+
+def copy_value(value):
+    """Returns value escaped for PostgreSQL's COPY text format, with
+    None as NULL"""
+    if value is None:
+        return '\\N'
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+class RowWriter(object):
+    """Formats matches for one query, in one of the `FORMATS`, or the
+    'copy' format loaded by `pg_copy.CopyStream`"""
+
+    def __init__(self, output, format, columns, counts=False, header=True):
+        """Create a writer, writing any header row immediately
+
+        :param output: OutputBuffer (or file like object) to write to
+        :param format: one of `FORMATS`, or 'copy'
+        :param columns: list of column names, context columns first,
+          only used by the text format to recognize a file column
+        :param counts: set if each match is written with a count
+        :param header: clear to leave out the header row, when
+          appending to output already holding one
+
+        """
+        self.output = output
+        self.format = format
+        self.columns = columns
+        if counts:
+            self.columns = columns + ['count']
+        self.file_column = bool(columns) and columns[0] == 'file'
+        if format == 'text':
+            # the common case, spared the format checks per match
+            self.emit = output.write
+            self.write = self.write_text
+        elif format == 'csv':
+            self.csv = csv.writer(output, lineterminator='\n')
+            if header:
+                self.csv.writerow(self.columns)
+        elif format == 'tsv' and header:
+            output.write('\t'.join(self.columns) + '\n')
+
+    def write(self, filename, context, values, count=None):
+        """Write a match
+
+        :param filename: the file containing the match, written as the
+          first column if file is a column
+        :param context: list of context values, in column order
+        :param values: list of sequence values, None for any the
+          segment didn't contain
+        :param count: number of times the match was found, when
+          writing counts
+
+        """
+        if self.file_column:
+            context = [filename] + context
+        if self.format == 'copy':
+            row = context + values
+            if count is not None:
+                row.append(str(count))
+            self.output.write('\t'.join(copy_value(v) for v in row) + '\n')
+            return
+
+        row = context + [v or '' for v in values]
+        if count is not None:
+            row.append(count if self.format == 'jsonl' else str(count))
+        if self.format == 'csv':
+            self.csv.writerow(row)
+        elif self.format == 'tsv':
+            self.output.write('\t'.join(
+                v.replace('\t', ' ').replace('\r', ' ') for v in row) + '\n')
+        else:
+            try:
+                line = json.dumps(OrderedDict(zip(self.columns, row)))
+            except UnicodeDecodeError:
+                line = json.dumps(OrderedDict(zip(
+                    self.columns, [text_value(v) for v in row])))
+            self.output.write(line + '\n')
+
+    def write_text(self, filename, context, values, count=None):
+        """`write` for the text format, joining the context with ':'
+        and the values present with '|'"""
+        if None in values:
+            values = [v for v in values if v is not None]
+        if self.file_column:
+            context = [filename] + context
+        if context:
+            line = ':'.join(context + ['|'.join(values)])
+        else:
+            line = '|'.join(values)
+        if count is None:
+            self.emit(line + '\n')
+        else:
+            self.emit('%7d %s\n' % (count, line))
+
+
+def shard_name(value):
+    """Returns value made safe to use in naming a shard file
+
+    Path separators and control characters are replaced, and leading
+    dots dropped, so a value can't name a file outside the shard's
+    directory.  Empty values become '_'.
+
+    """
+    return SHARD_UNSAFE.sub('_', value).lstrip('.') or '_'
+
+
+class ShardFiles(object):
+    """The shard files written by `ShardWriter`s, a bounded number
+    kept open at once
+
+    Files are opened as rows arrive for them.  Once max_open are
+    open, one not written for a while is flushed and closed, along
+    with the RowWriters writing to it.  Files are kept in the order
+    opened, and one written since it reached the front is given a
+    second chance at the back, approximating least recently written
+    without reordering on every row.  A file is truncated the first
+    time it is opened, and appended to should it be reopened.  Files
+    named with a '.gz' suffix are written through gzip.  Missing
+    directories are created.
+
+    Nothing is kept of a closed file, so memory doesn't grow with the
+    number of shards.  Instead, a file modified since this run created
+    its first shard is taken as one of its own, and reopened for
+    appending.  The comparison is against the first shard's mtime, so
+    both times come from the file system's clock.
+
+    """
+
+    def __init__(self, max_open=MAX_OPEN_SHARDS, stats=None):
+        self.max_open = max_open
+        self.stats = stats
+        # path: (OutputBuffer, {ShardWriter: RowWriter}), in the order
+        # opened or last given a second chance; files written since
+        # are noted in recent rather than moved on every row
+        self.open_files = OrderedDict()
+        self.recent = set()
+        self.started = None
+
+    def get(self, path):
+        """Returns (OutputBuffer for path, the dictionary of the
+        RowWriters writing to it by ShardWriter, True if path was
+        just created)"""
+        entry = self.open_files.get(path)
+        if entry is not None:
+            self.recent.add(path)
+            return entry + (False,)
+        while len(self.open_files) >= self.max_open:
+            oldest, entry = self.open_files.popitem(last=False)
+            if oldest in self.recent:
+                # written since it last came up, so goes to the back
+                self.recent.discard(oldest)
+                self.open_files[oldest] = entry
+            else:
+                entry[0].close()
+        created = not self.written(path)
+        mode = 'wb' if created else 'ab'
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if path.endswith('.gz'):
+            stream = open_compressed(path, 'gzip', mode)
+        else:
+            stream = open(path, mode, SHARD_BUFFER_SIZE)
+        if self.started is None:
+            self.started = os.stat(path).st_mtime
+        entry = self.open_files[path] = (
+            OutputBuffer(stream, SHARD_BUFFER_SIZE, self.stats), {})
+        return entry + (created,)
+
+    def written(self, path):
+        """Returns True if path was already written by this run"""
+        if self.started is None:
+            return False
+        try:
+            return os.stat(path).st_mtime >= self.started
+        except OSError:
+            return False
+
+    def flush(self):
+        for output, rows in self.open_files.values():
+            output.flush()
+
+    def close(self):
+        """Flush and close all the open files"""
+        for output, rows in self.open_files.values():
+            output.close()
+        self.open_files.clear()
+        self.recent.clear()
+
+    def abort(self):
+        """Close after a failed run; shards are plain files, so this
+        is the same as `close`"""
+        self.close()
+
+
+class ShardWriter(object):
+    """Writes the matches of one query to shard files, each row to
+    the file named by expanding a template with values from its
+    message, i.e. 'out/{MSH-7:8}/{MSH-9.1}.tsv.gz'"""
+
+    def __init__(self, files, template, format, columns, counts,
+                 shard_fields):
+        """Create a writer
+
+        :param files: ShardFiles shared by all the sharded queries
+        :param template: filename holding {FIELD} references
+        :param format: one of `FORMATS`
+        :param columns: list of column names, as for RowWriter
+        :param counts: set if each match is written with a count
+        :param shard_fields: the references of all the queries'
+          templates, the order of the trailing context entries
+          holding their values (see `Parser.shard_fields`)
+
+        """
+        self.output = files
+        self.template = template
+        self.format = format
+        self.columns = columns
+        self.counts = counts
+        self.shard_fields = [ref.reference for ref in shard_fields]
+        # the paths of recent shard values, no more kept than files
+        # may be open
+        self.paths = OrderedDict()
+
+    def path(self, shards):
+        """Returns the shard file for the trailing context shards"""
+        values = dict(zip(self.shard_fields, shards))
+        return SHARD_FIELD.sub(
+            lambda found: shard_name(values[found.group(1)]), self.template)
+
+    def write(self, filename, context, values, count=None):
+        """Write a match to its shard, see `RowWriter.write`"""
+        split = len(context) - len(self.shard_fields)
+        shards = tuple(context[split:])
+        path = self.paths.get(shards)
+        if path is None:
+            if len(self.paths) >= self.output.max_open:
+                self.paths.popitem(last=False)
+            path = self.paths[shards] = self.path(shards)
+        output, rows, created = self.output.get(path)
+        writer = rows.get(self)
+        if writer is None:
+            writer = rows[self] = RowWriter(
+                output, self.format, self.columns, self.counts, created)
+        writer.write(filename, context[:split], values, count)
+
+
 class Parser(object):
     
     def __init__(self):
-        self.segments_of_interest = ""
-        self.sequences = []
+        self.queries = []
+        self.filters = []
         self.filelist = []
         self.show_ADT = False
         self.show_file = False
         self.show_time = False
         self.show_visitID = False
         self.show_pc = False
+        self.jobs = 1
+        self.ordered = False
+        self.split_size = SPLIT_SIZE
+        self.memory_map = False
+        self.use_index = False
+        self.format = FORMATS[0]
+        self.count = False
+        self.group_by = []
+        self.carry = []
+        self.patterns = []
+        self.checkpoint = None
+        self.follow = False
+        self.interval = 5.0
+        self.stats = None
+        self.profile = None
+        self.manifest = None
+        self.dedup = False
+        self.dedup_capacity = DEDUP_CAPACITY
+        self.seen = None
+        self.copy = None
+        self.sort_by_time = False
+        self.since = None
+        self.until = None
+        self.max_segment = None
+        self.memory_limit = None
+        self.max_open_shards = MAX_OPEN_SHARDS
 
-    def processArgs(self, argv):
+    def processArgs(self, argv, require_files=True):
         """ Process any optional arguments and possitional parameters
+
+        :param require_files: clear when the messages come from
+          elsewhere, such as the MLLP listener, in which case no input
+          files are accepted
+
         """
         parser = OptionParser(usage=usage)
         parser.add_option("-a", "--show_ADT", action="store_true", dest="show_ADT",
@@ -51,33 +1767,270 @@ class Parser(object):
                           dest="show_pc",
                           default=self.show_pc,
                           help="Display patient class")
+        parser.add_option("-j", "--jobs", type="int", dest="jobs",
+                          default=self.jobs,
+                          help="Number of worker processes to scan with, "
+                          "large files are split at message boundaries")
+        parser.add_option("-o", "--ordered", action="store_true",
+                          dest="ordered", default=self.ordered,
+                          help="With --jobs, keep the output in input "
+                          "file order, identical to a single process run")
+        parser.add_option("-m", "--mmap", action="store_true",
+                          dest="memory_map", default=self.memory_map,
+                          help="Memory map input files, copying out only "
+                          "the segments of interest; slower than the "
+                          "default streaming reader, see --index instead")
+        parser.add_option("-i", "--index", action="store_true",
+                          dest="use_index", default=self.use_index,
+                          help="Read only the segments of interest, "
+                          "located via an index sidecar (filename%s) "
+                          "that is built when missing or out of date"
+                          % INDEX_SUFFIX)
+        parser.add_option("-q", "--query", action="append", dest="queries",
+                          default=[], metavar="QUERY",
+                          help="segment:sequence[,sequence]*[:outfile] "
+                          "to extract, may be repeated to run several "
+                          "queries in a single pass")
+        parser.add_option("-s", "--spec", dest="spec",
+                          help="File listing the queries to run, one "
+                          "per line as 'segment sequence[,sequence]* "
+                          "[outfile]'")
+        parser.add_option("-w", "--where", action="append", dest="filters",
+                          default=[], metavar="FILTER",
+                          help="Only display matches from messages where "
+                          "segment-sequence[.component]=value (or !=), "
+                          "i.e. PV1-2.1=E; may be repeated")
+        parser.add_option("-F", "--format", type="choice", choices=FORMATS,
+                          dest="format", default=self.format,
+                          help="Output format, one of %s (default %s)" %
+                          ('|'.join(FORMATS), FORMATS[0]))
+        parser.add_option("-c", "--count", action="store_true",
+                          dest="count", default=self.count,
+                          help="Display a count of each distinct match "
+                          "rather than the matches themselves")
+        parser.add_option("-C", "--carry", action="append",
+                          dest="carry", default=[], metavar="FIELD",
+                          help="Add this field from the most recent "
+                          "earlier segment of its type in the message "
+                          "to each match, i.e. OBR-4; may be repeated")
+        parser.add_option("-g", "--group-by", action="append",
+                          dest="group_by", default=[], metavar="FIELD",
+                          help="Count matches by this field from the "
+                          "message as well, i.e. MSH-7:8 for the day; "
+                          "implies --count, may be repeated")
+        parser.add_option("-k", "--checkpoint", dest="checkpoint",
+                          metavar="FILE", default=self.checkpoint,
+                          help="Resume from the file offsets saved in "
+                          "FILE, scanning only appended messages, and "
+                          "save the new offsets on completion")
+        parser.add_option("--follow", action="store_true", dest="follow",
+                          default=self.follow,
+                          help="Keep watching the files for appended "
+                          "messages; requires --checkpoint")
+        parser.add_option("--interval", type="float", dest="interval",
+                          default=self.interval,
+                          help="Seconds between checks for appended "
+                          "messages (default %default)")
+        parser.add_option("--manifest", dest="manifest", metavar="FILE",
+                          default=self.manifest,
+                          help="Record each file's size, mtime and hash "
+                          "in FILE, and its matches alongside, scanning "
+                          "only new or "
+                          "changed files on later runs and replaying "
+                          "the recorded matches for the rest")
+        parser.add_option("--dedup", action="store_true", dest="dedup",
+                          default=self.dedup,
+                          help="Skip messages repeating the control id "
+                          "(MSH-10) of one already seen")
+        parser.add_option("--dedup-capacity", type="int",
+                          dest="dedup_capacity", default=self.dedup_capacity,
+                          help="Number of control ids --dedup is first "
+                          "sized for, growing beyond (default %default)")
+        parser.add_option("--copy", dest="copy", metavar="SECTION",
+                          default=self.copy,
+                          help="Load the matches into PostgreSQL, each "
+                          "query's outfile naming its table, connecting "
+                          "with the settings in SECTION of the config "
+                          "file")
+        parser.add_option("--since", dest="since", metavar="TIME",
+                          default=self.since,
+                          help="Only scan messages with MSH-7 at or "
+                          "after TIME, i.e. 20130101, comparing as "
+                          "many digits as given")
+        parser.add_option("--until", dest="until", metavar="TIME",
+                          default=self.until,
+                          help="Only scan messages with MSH-7 at or "
+                          "before TIME, comparing as many digits as "
+                          "given")
+        parser.add_option("--sort-by-time", action="store_true",
+                          dest="sort_by_time", default=self.sort_by_time,
+                          help="Merge the matches from all files in "
+                          "message time (MSH-7) order")
+        parser.add_option("--shard", dest="shard", metavar="TEMPLATE",
+                          default=None,
+                          help="Write the matches of queries without an "
+                          "outfile to files named by TEMPLATE, i.e. "
+                          "'out/{MSH-7:8}/{MSH-9.1}.tsv.gz'")
+        parser.add_option("--max-open-shards", type="int",
+                          dest="max_open_shards", metavar="N",
+                          default=self.max_open_shards,
+                          help="Most shard files kept open at once "
+                          "(default %default)")
+        parser.add_option("--max-segment", type="int", dest="max_segment",
+                          metavar="BYTES", default=self.max_segment,
+                          help="Truncate fields longer than BYTES as "
+                          "they are read, i.e. OBX-5 values embedding "
+                          "whole documents")
+        parser.add_option("--memory-limit", type="int", dest="memory_limit",
+                          metavar="MB", default=None,
+                          help="With --count, spill the distinct matches "
+                          "to temporary files beyond roughly MB "
+                          "megabytes")
+        parser.add_option("--stats", action="store_true", dest="stats",
+                          default=False,
+                          help="Report bytes, messages and segments "
+                          "scanned and the time spent reading, scanning "
+                          "and writing to stderr")
+        parser.add_option("--profile", dest="profile", metavar="FILE",
+                          default=self.profile,
+                          help="Run under cProfile, writing the profile "
+                          "to FILE; with --jobs only the parent process "
+                          "is profiled")
 
-        (options, pargs) = parser.parse_args()
-        if len(pargs) < 3:
-            parser.error("incorrect number of arguments")
+        (options, pargs) = parser.parse_args(argv)
+        query_specs = [query.split(':', 2) for query in options.queries]
+        if options.spec:
+            try:
+                with open(options.spec) as spec:
+                    for line in spec:
+                        if line.strip() and not line.startswith('#'):
+                            query_specs.append(line.split())
+            except IOError:
+                parser.error("can't open spec file %s" % options.spec)
+        if not query_specs:
+            if len(pargs) < (3 if require_files else 2):
+                parser.error("incorrect number of arguments")
+            query_specs.append(pargs[:2])
+            pargs = pargs[2:]
 
         self.show_ADT = parser.values.show_ADT
         self.show_file = parser.values.show_file
         self.show_time = parser.values.show_time
         self.show_visitID = parser.values.show_visitID
         self.show_pc = parser.values.show_pc
-        
-        self.segments_of_interest = pargs.pop(0)
-        if len(self.segments_of_interest) != 3:
-            parser.error("segment '%s' looks incorrect, expected something like 'PV1'"
-                         % self.segments_of_interest)
+        self.jobs = parser.values.jobs
+        self.ordered = parser.values.ordered
+        self.memory_map = parser.values.memory_map
+        self.use_index = parser.values.use_index
+        self.format = parser.values.format
+        self.count = parser.values.count or bool(options.group_by)
+        self.checkpoint = parser.values.checkpoint
+        self.follow = parser.values.follow
+        self.interval = parser.values.interval
+        self.profile = parser.values.profile
+        self.manifest = parser.values.manifest
+        self.dedup = parser.values.dedup
+        self.dedup_capacity = parser.values.dedup_capacity
+        self.copy = parser.values.copy
+        self.sort_by_time = parser.values.sort_by_time
+        self.since = parser.values.since
+        self.until = parser.values.until
+        self.max_segment = parser.values.max_segment
+        self.max_open_shards = parser.values.max_open_shards
+        if parser.values.memory_limit is not None:
+            self.memory_limit = parser.values.memory_limit << 20
+        for bound in (self.since, self.until):
+            if bound is not None and not bound.isdigit():
+                parser.error("time '%s' looks incorrect, expected "
+                             "something like 20130101" % bound)
+        if self.copy:
+            self.format = 'copy'
+        if parser.values.stats:
+            self.stats = Stats()
+        if self.jobs < 1:
+            parser.error("jobs must be a positive integer")
+        if self.follow and not self.checkpoint:
+            parser.error("--follow requires --checkpoint")
+        if self.checkpoint and (self.jobs > 1 or self.count):
+            parser.error("--checkpoint can't be combined with --jobs "
+                         "or --count")
+        if self.checkpoint and self.manifest:
+            parser.error("--checkpoint can't be combined with --manifest")
+        if self.checkpoint and self.use_index:
+            # the index of a growing file would be rebuilt every poll
+            parser.error("--checkpoint can't be combined with --index")
+        if self.dedup and self.manifest:
+            parser.error("--dedup can't be combined with --manifest")
+        if self.sort_by_time and (self.jobs > 1 or self.checkpoint or
+                                  self.manifest):
+            parser.error("--sort-by-time can't be combined with --jobs, "
+                         "--checkpoint or --manifest")
+        if self.dedup_capacity < 1:
+            parser.error("dedup-capacity must be a positive integer")
+        if self.max_open_shards < 1:
+            parser.error("max-open-shards must be a positive integer")
+        if self.max_segment is not None and self.max_segment < 4:
+            parser.error("max-segment must be at least 4 bytes")
+        if self.memory_limit is not None and self.memory_limit < 1:
+            parser.error("memory-limit must be a positive integer")
+        try:
+            self.filters = [Filter(expression) for expression in
+                            options.filters]
+            self.group_by = [FieldRef(reference) for reference in
+                             options.group_by]
+            self.carry = [FieldRef(reference) for reference in
+                          options.carry]
+        except ValueError, e:
+            parser.error(str(e))
+
+        for query_spec in query_specs:
+            if len(query_spec) not in (2, 3):
+                parser.error("query '%s' looks incorrect, expected "
+                             "something like 'PV1:2,3'" % ':'.join(query_spec))
+            segment = query_spec[0]
+            if len(segment) != 3:
+                parser.error("segment '%s' looks incorrect, expected something like 'PV1'"
+                             % segment)
+            try:
+                sequences = parse_sequences(segment, query_spec[1])
+            except ValueError:
+                parser.error("sequence must be an integer, separate multiple w/ comma and no spaces")
+            output = query_spec[2] if len(query_spec) == 3 else None
+            self.queries.append(Query(segment, sequences,
+                                      output or options.shard))
 
         try:
-            nums = pargs.pop(0).split(",")
-            for num in nums:
-                if 'MSH' == self.segments_of_interest:
-                    num = int(num) - 1
-                self.sequences.append(int(num))
-        except:
-            parser.error("sequence must be an integer, separate multiple w/ comma and no spaces")
+            self.shard_fields()
+        except ValueError, e:
+            parser.error(str(e))
+        for query in self.queries:
+            if (SHARD_FIELD.search(query.output or '') and
+                    query.output.endswith('.zip')):
+                parser.error("shards can only be gzip compressed, "
+                             "not '%s'" % query.output)
+
+        if self.copy:
+            for query in self.queries:
+                if not TABLE_NAME.match(query.output or ''):
+                    parser.error("with --copy each query needs a table "
+                                 "name for its outfile, not '%s'" %
+                                 (query.output or ''))
+        if self.format in ('tsv', 'csv', 'copy'):
+            outputs = [query.output for query in self.queries]
+            if len(set(outputs)) != len(outputs):
+                parser.error("with --format %s each query needs its own "
+                             "outfile" % self.format)
+
+        if not require_files:
+            if pargs:
+                parser.error("unexpected arguments: %s" % ' '.join(pargs))
+            return
 
+        self.patterns = pargs
         for patternOrFile in pargs:
             for file in glob.glob(patternOrFile):
+                if is_sidecar(file):
+                    continue
                 if not os.path.isfile(file):
                     parser.error("can't open input file %s" % file)
                 self.filelist.append(file)
@@ -87,64 +2040,742 @@ class Parser(object):
             parser.error("at least one input file is required")
 
     def parse(self):
+        begin = time.time()
+        writers = self.open_outputs()
+        counts = SpillingCounter(self.memory_limit)
+        if self.dedup:
+            self.seen = SeenSet(self.dedup_capacity)
+        if (self.since or self.until) and not self.checkpoint:
+            self.filelist = [filename for filename in self.filelist
+                             if self.in_window(filename)]
+        failed = True
+        try:
+            if self.checkpoint:
+                self.parse_appended(writers)
+            elif self.manifest:
+                self.parse_manifest(writers, counts)
+            elif self.sort_by_time:
+                self.parse_by_time(writers, counts)
+            elif self.jobs > 1:
+                self.parse_parallel(writers, counts)
+            else:
+                for filename in self.filelist:
+                    self.process(writers, counts, filename)
+            if self.count:
+                self.write_counts(writers, counts)
+            failed = False
+        finally:
+            counts.close()
+            for output in self.buffers(writers):
+                if failed:
+                    output.abort()
+                else:
+                    output.close()
+        if self.stats:
+            self.stats.report(sys.stderr, time.time() - begin,
+                              self.jobs > 1 and not self.checkpoint)
+
+    def process(self, writers, counts, filename, start=0, end=None):
+        """Scan the byte range [start, end) of filename
+
+        The matches are written, or added to counts when counting.
+
+        """
+        with open_input(filename) as FILE:
+            matches = self.matches(FILE, start, end)
+            if self.count:
+                self.tally(filename, matches, counts)
+            else:
+                self.write_matches(writers, filename, start, matches)
+
+    def parse_appended(self, writers):
+        """Scan only the complete messages appended since the checkpoint
+
+        Offsets are saved to the `checkpoint` file after each pass.
+        With `follow` set, passes repeat every `interval` seconds
+        until interrupted.
+
+        """
+        offsets = load_checkpoint(self.checkpoint)
+        while True:
+            for filename in self.watched_files():
+                self.process_appended(writers, offsets, filename)
+            save_checkpoint(self.checkpoint, offsets)
+            if not self.follow:
+                break
+            for output in self.buffers(writers):
+                output.flush()
+            time.sleep(self.interval)
+
+    def watched_files(self):
+        """Returns the input files, expanding the glob patterns anew
+        when following, so files created since are picked up"""
+        if not self.follow:
+            return self.filelist
+        filelist = []
+        for patternOrFile in self.patterns:
+            for filename in glob.glob(patternOrFile):
+                if is_sidecar(filename):
+                    continue
+                if os.path.isfile(filename) and filename not in filelist:
+                    filelist.append(filename)
+        return filelist
+
+    def process_appended(self, writers, offsets, filename):
+        """Scan the complete messages appended to filename
+
+        :param offsets: the {filename: (offset, inode)} checkpoint,
+          updated with the offset reached
+
+        See `appended_range` for which messages are complete.
+        Compressed files are scanned whole, again only if they change.
+
+        """
+        appended = appended_range(filename, offsets.get(filename, (0, None)),
+                                  self.interval)
+        if appended is not None:
+            start, end, inode = appended
+            self.process(writers, None, filename, start, end)
+            offsets[filename] = (end, inode)
+
+    def parse_manifest(self, writers, counts):
+        """Scan only the files new or changed since the manifest
+
+        The matches of unchanged files are replayed from those
+        recorded, so the output is as if every file were scanned.
+        Matches are streamed to and from their files, never held in
+        memory.  Files no longer present are dropped from the
+        manifest, which is saved once all files are done.
+
+        """
+        key = self.manifest_key()
+        entries = load_manifest(self.manifest, key)
+        changed = [filename for filename in self.filelist
+                   if not self.unchanged(entries, filename) or
+                   not os.path.exists(self.recorded(entries, filename))]
+        self.record_files(entries, changed)
+
         for filename in self.filelist:
-            if self.show_file:
-                print "READING FILE:",filename
-
-            FILE = open(filename, "r")
-            # by default, the files don't contain newlines.  read the whole
-            # thing in and split on \r
-            raw = FILE.read()
-
-            # occasionally we have a newline type file from a direct
-            # SQL query or the like - convert back
-            if raw.find('\n') > 0:
-                raw = raw.replace('\n','\r')
-            if raw.find('\\r') > 0:
-                raw = raw.replace('\\r','\r')
-
-            for l in raw.split('\r'):
-                # hang onto useful message header info and purge
-                # potentials from the previous message
-                if 'MSH' == l[0:3]:
-                    sequences = l.split('|')
-                    TIME = sequences[6]
-                    ADT = sequences[8]
-                    PATIENTCLASS, VISITID = '', ''
-
-                # hang onto visit id if requested
-                if self.show_visitID and 'PID' == l[0:3]:
-                    sequences = l.split('|')
-                    VISITID = sequences[18]
-
-                # hang onto patient_class if requested
-                if self.show_pc and 'PV1' == l[0:3]:
-                    sequences = l.split('|')
-                    PATIENTCLASS = sequences[2].split('^')[0]
-
-                # print this out if it matches
-                if self.segments_of_interest == l[0:3]:
-                    sequences = l.split('|')
-                    out = "|".join(
-                        [sequences[e] for e in self.sequences if e < len(sequences)])
-                    # strip newlines
-                    out = out.replace("\n","")
-                    if out:
-                        if self.show_time:
-                            out = ":".join([TIME,out])
-                        if self.show_ADT:
-                            out = ":".join([ADT,out])
-                        if self.show_pc:
-                            out = ":".join([PATIENTCLASS,out])
-                        if self.show_visitID:
-                            out = ":".join([VISITID,out])
-
-                        print out
+            matches = load_matches(self.recorded(entries, filename))
+            if self.count:
+                self.tally(filename, matches, counts)
+            else:
+                self.write_matches(writers, filename, 0, matches)
+        for filename in entries.keys():
+            if not os.path.exists(filename):
+                del entries[filename]
+        save_manifest(self.manifest, key, entries)
+
+    def manifest_key(self):
+        """Returns what the manifest's matches depend upon: the
+        queries, filters, time window, requested context, the fields
+        naming shards and the segment length limit"""
+        return (tuple((q.segment, tuple(q.sequences)) for q in self.queries),
+                tuple((f.field.reference, f.negate, f.expected)
+                      for f in self.filters),
+                (self.since, self.until), tuple(self.context_columns()),
+                tuple(ref.reference for ref in self.shard_fields()),
+                self.max_segment)
+
+    def in_window(self, filename):
+        """Returns False if filename holds no messages within the
+        --since / --until window, judged by its time range sidecar
+
+        Files whose sidecar can't be written, i.e. in a read only
+        archive, are taken as in the window and simply scanned.
+
+        """
+        try:
+            earliest, latest = load_time_range(filename)
+        except (IOError, OSError):
+            return True
+        if earliest is None:
+            return False
+        if self.since and latest[:len(self.since)] < self.since:
+            return False
+        if self.until and earliest[:len(self.until)] > self.until:
+            return False
+        return True
+
+    def unchanged(self, entries, filename):
+        """Returns True if the manifest entry for filename is current
+
+        Files whose size and mtime match are taken as unchanged;
+        when only the mtime differs, the content hash decides.  A
+        fresh entry (without matches) replaces any that isn't
+        current.
+
+        """
+        stat = os.stat(filename)
+        entry = entries.get(filename)
+        if entry and (entry['size'], entry['mtime']) == (stat.st_size,
+                                                         stat.st_mtime):
+            return True
+        digest = file_hash(filename)
+        if entry and (entry['size'], entry['hash']) == (stat.st_size,
+                                                        digest):
+            entry['mtime'] = stat.st_mtime
+            return True
+        entries[filename] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                             'hash': digest}
+        return False
+
+    def recorded(self, entries, filename):
+        """Returns the file recording the matches of filename"""
+        return matches_filename(self.manifest, entries[filename]['hash'])
+
+    def record_files(self, entries, filelist):
+        """Scan filelist, recording the matches of each file
+
+        With `jobs` set, the files are scanned by a pool of workers.
+        Their pieces are taken in order, so each file's matches are
+        recorded as its pieces complete.
+
+        """
+        if self.jobs == 1 or not filelist:
+            for filename in filelist:
+                with open_input(filename) as FILE:
+                    save_matches(self.recorded(entries, filename),
+                                 self.matches(FILE))
+            return
+
+        def pieced(pieces):
+            for filename, start, matches, stats in pieces:
+                if stats:
+                    self.stats.add(stats)
+                for match in matches:
+                    yield match
+
+        # workers return the matches themselves, even when counting
+        worker = self.pool_worker()
+        worker.count = False
+        self.prepare_indexes(filelist)
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            jobs = ((worker, filename, start, end) for filename, start, end
+                    in self.ranges(filelist))
+            for filename, pieces in itertools.groupby(
+                    pool.imap(_scan_job, jobs), lambda piece: piece[0]):
+                save_matches(self.recorded(entries, filename),
+                             pieced(pieces))
+        finally:
+            pool.close()
+            pool.join()
+
+    def parse_by_time(self, writers, counts):
+        """Scan all the files at once, merging their messages by time
+
+        Every file is kept open, and a heap holds the next message of
+        each, so memory use doesn't grow with the volume of input.
+        Messages with the same time are taken in file list order.
+
+        """
+        files = []
+        try:
+            for filename in self.filelist:
+                files.append(open_input(filename))
+            merged = heapq.merge(*[
+                self.timed_messages(order, FILE)
+                for order, FILE in enumerate(files)])
+            plan = self.scan_plan()
+            for when, order, sequence, segments in merged:
+                filename = self.filelist[order]
+                matches = self.scan(segments, plan)
+                if self.stats:
+                    matches = self.stats.matched(matches)
+                if self.count:
+                    self.tally(filename, matches, counts)
+                else:
+                    for index, context, values in matches:
+                        writers[index].write(filename, context, values)
+        finally:
+            for FILE in files:
+                FILE.close()
+
+    def timed_messages(self, order, FILE):
+        """Generate (time, order, sequence, segments) for each message
+
+        :param order: position of the file in the file list
+        :param FILE: file like object, as returned from `open_input`
+
+        The time is MSH-7, compared as a string, and sequence the
+        position of the message in the file.  Only the segments
+        `scan` makes use of are included.
+
+        """
+        message = []
+        sequence = 0
+        for segment in self.segments(FILE):
+            if 'MSH' == segment[0:3] and message:
+                yield self.message_time(message[0]), order, sequence, message
+                message = []
+                sequence += 1
+            message.append(segment)
+        if message:
+            yield self.message_time(message[0]), order, sequence, message
+
+    def message_time(self, segment):
+        """Returns MSH-7 of a message's first segment, or '' for
+        segments preceding any MSH"""
+        if 'MSH' != segment[0:3]:
+            return ''
+        sequences = segment.split(delimiters(segment).field, 7)
+        return sequences[6] if len(sequences) > 6 else ''
+
+    def write_matches(self, writers, filename, start, matches):
+        """Write the matches found in the piece of filename at start"""
+        if start == 0:
+            self.begin_file(writers, filename)
+        for index, context, values in matches:
+            writers[index].write(filename, context, values)
+
+    def tally(self, filename, matches, counts=None):
+        """Returns a Counter of the distinct matches
+
+        Counter keys are (query index, filename, context, values)
+        tuples, the filename being None unless it is a column.  If
+        counts, a Counter or `SpillingCounter`, is given the matches
+        are added to it instead.
+
+        """
+        if self.show_file:
+            counted = filename
+        else:
+            counted = None
+        if counts is None:
+            counts = Counter()
+        counter = counts
+        if isinstance(counts, SpillingCounter):
+            if counts.limit is not None:
+                add = counts.add
+                for index, context, values in matches:
+                    add((index, counted, tuple(context), tuple(values)))
+                return counts
+            # without a limit the keys are simply counted in memory
+            counter = counts.counts
+        for index, context, values in matches:
+            counter[(index, counted, tuple(context), tuple(values))] += 1
+        return counts
+
+    def write_counts(self, writers, counts):
+        """Write the counted matches, sorted within each query"""
+        for key, count in counts.sorted_items():
+            index, filename, context, values = key
+            writers[index].write(filename, list(context), list(values),
+                                 count)
+
+    def context_columns(self):
+        """Returns the names of the context columns, in output order"""
+        columns = []
+        if self.file_column():
+            columns.append('file')
+        for name, flag, reference in LEGACY_CONTEXT:
+            if getattr(self, flag):
+                columns.append(name)
+        return columns + [ref.reference for ref in self.carry + self.group_by]
+
+    def file_column(self):
+        """Returns True if -f is shown as a file column, rather than
+        by noting the start of each file in the text output, as it is
+        wherever the matches of several files may interleave"""
+        if not self.show_file:
+            return False
+        interleaved = self.sort_by_time or (
+            self.jobs > 1 and not self.ordered and
+            not (self.checkpoint or self.manifest))
+        return self.format != 'text' or self.count or interleaved
+
+    def context_fields(self):
+        """Returns the FieldRefs captured for the context, in
+        `context_columns` order less any file column, followed by the
+        `shard_fields`"""
+        return ([FieldRef(reference) for name, flag, reference in
+                 LEGACY_CONTEXT if getattr(self, flag)] +
+                self.carry + self.group_by + self.shard_fields())
+
+    def shard_fields(self):
+        """Returns the FieldRefs referenced by the queries' shard
+        templates, each once, in order of appearance
+
+        Their values are captured as trailing context entries, which
+        each `ShardWriter` takes off before writing the row.
+
+        """
+        references = []
+        for query in self.queries:
+            for reference in SHARD_FIELD.findall(query.output or ''):
+                if reference not in references:
+                    references.append(reference)
+        return [FieldRef(reference) for reference in references]
+
+    def open_outputs(self):
+        """Returns the list of RowWriters, one for each query
+
+        Queries naming the same output file share an OutputBuffer, as
+        do all those writing to stdout.  With `copy` set, each query's
+        OutputBuffer loads its table instead.  Queries whose output
+        is a shard template get a ShardWriter, all sharing one
+        ShardFiles.
+
+        """
+        buffers = {None: OutputBuffer(sys.stdout, stats=self.stats)}
+        writers = []
+        shards = None
+        for query in self.queries:
+            if SHARD_FIELD.search(query.output or ''):
+                if shards is None:
+                    shards = ShardFiles(self.max_open_shards, self.stats)
+                writers.append(ShardWriter(
+                    shards, query.output, self.format,
+                    self.context_columns() + query.columns(), self.count,
+                    self.shard_fields()))
+                continue
+            if query.output in buffers:
+                pass
+            elif self.copy:
+                # only those loading a database need psycopg2
+                from pheme.util.pg_copy import CopyStream
+                buffers[query.output] = OutputBuffer(
+                    CopyStream(self.copy, query.output), COPY_BATCH_SIZE,
+                    self.stats)
+            else:
+                buffers[query.output] = OutputBuffer(
+                    open(query.output, 'w', BUFFER_SIZE), stats=self.stats)
+            writers.append(RowWriter(buffers[query.output], self.format,
+                                     self.context_columns() +
+                                     query.columns(), self.count))
+        return writers
+
+    def buffers(self, writers):
+        """Returns the distinct OutputBuffers used by writers"""
+        buffers = []
+        for writer in writers:
+            if writer.output not in buffers:
+                buffers.append(writer.output)
+        return buffers
+
+    def begin_file(self, writers, filename):
+        """Note the start of filename in the text output, if requested"""
+        if self.show_file and not self.file_column():
+            for output in self.buffers(writers):
+                # shards have no single stream to note it in
+                if isinstance(output, OutputBuffer):
+                    output.write("READING FILE: %s\n" % filename)
+
+    def parse_parallel(self, writers, counts):
+        """Spread the work over a pool of `jobs` processes
+
+        Each file, or piece of a file larger than `split_size`, is
+        scanned by a worker.  Output is written as the pieces
+        complete, or in input order if `ordered` is set.  When
+        counting, each worker's tally is added to counts instead.
+        With `dedup`, the workers report each message's control id and
+        the duplicates are dropped here, against the one `seen` set.
+
+        """
+        self.prepare_indexes(self.filelist)
+        worker = self.pool_worker()
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            jobs = ((worker, filename, start, end) for filename, start, end
+                    in self.ranges())
+            mapper = pool.imap if self.ordered else pool.imap_unordered
+            for filename, start, matches, stats in mapper(_scan_job, jobs):
+                if stats:
+                    self.stats.add(stats)
+                if self.dedup:
+                    matches = self.unique_matches(*matches)
+                    if self.count:
+                        self.tally(filename, matches, counts)
+                        continue
+                if self.count:
+                    counts.update(matches)
+                    matches.close()
+                else:
+                    self.write_matches(writers, filename, start, matches)
+        finally:
+            pool.close()
+            pool.join()
+
+    def pool_worker(self):
+        """Returns the copy of this parser to be pickled into every
+        pool job, less the state only the parent needs
+
+        The file list and patterns can be long, and the `seen` set
+        large, so they are dropped rather than sent with each job.
+
+        """
+        worker = copy.copy(self)
+        worker.filelist = []
+        worker.patterns = []
+        worker.seen = None
+        return worker
+
+    def prepare_indexes(self, filelist):
+        """With `use_index`, build any missing indexes for filelist
+        once, before the pool's workers need them; those that can't
+        be written are left to the workers to read without"""
+        if self.use_index:
+            for filename in filelist:
+                if not zip_protocol(filename):
+                    try:
+                        load_index(filename, ())
+                    except (IOError, OSError):
+                        pass
+
+    def unique_matches(self, starts, found):
+        """Generate the matches found by a worker, less those of
+        messages already `seen`
+
+        :param starts: list of (control id, index into found of the
+          message's first match), as noted by `_MessageLog`
+        :param found: list of the worker's matches
+
+        """
+        ends = [begin for key, begin in starts[1:]] + [len(found)]
+        for match in found[:starts[0][1] if starts else len(found)]:
+            yield match
+        for (key, begin), end in zip(starts, ends):
+            if self.seen.add(key):
+                for match in found[begin:end]:
+                    yield match
+
+    def ranges(self, filelist=None):
+        """Generate (filename, start, end) byte ranges to scan
+
+        :param filelist: the files to scan, defaults to `filelist`
+
+        Files larger than `split_size` are broken at message
+        boundaries into pieces of roughly `split_size` bytes.
+        Compressed files are never split, and are given an end of
+        None.
+
+        """
+        if filelist is None:
+            filelist = self.filelist
+        for filename in filelist:
+            if zip_protocol(filename):
+                # compressed streams can only be read start to finish
+                yield filename, 0, None
+                continue
+            size = os.path.getsize(filename)
+            start = 0
+            with open(filename, 'rb') as FILE:
+                while start + self.split_size < size:
+                    end = message_boundary(FILE, start + self.split_size)
+                    if end is None:
+                        break
+                    yield filename, start, end
+                    start = end
+            yield filename, start, size
+
+    def segment_types(self):
+        """Returns the set of segment types `scan` makes use of"""
+        return set(['MSH'] + [query.segment for query in self.queries] +
+                   [f.field.segment for f in self.filters] +
+                   [ref.segment for ref in self.context_fields()])
+
+    def segments(self, FILE, start=0, end=None):
+        """Returns an iterator over the segments of FILE to scan
+
+        :param FILE: file like object containing HL7 messages, as
+          returned from `open_input`
+        :param start: byte offset from which to begin
+        :param end: byte offset at which to stop, defaults to the end
+          of the file
+
+        Expanded (compressed) input is always read as a stream, from
+        start to finish.  With `use_index`, files whose index sidecar
+        can't be written, i.e. in a read only archive, are read as
+        they would be without it.
+
+        """
+        reader = ReadTimer(FILE, self.stats) if self.stats else FILE
+        index = None
+        if self.use_index and isinstance(FILE, file):
+            try:
+                index = load_index(FILE.name, self.segment_types())
+            except (IOError, OSError):
+                pass
+        if not isinstance(FILE, file):
+            segments = iter_segments(reader,
+                                     segment_types=self.segment_types(),
+                                     max_segment=self.max_segment)
+        elif index is not None:
+            segments = iter_indexed_segments(reader, index, start, end,
+                                             self.max_segment)
+        else:
+            if end is None:
+                end = os.fstat(FILE.fileno()).st_size
+            if self.memory_map:
+                segments = iter_mapped_segments(FILE, self.segment_types(),
+                                                start, end, self.max_segment)
+                if self.stats:
+                    self.stats.bytes_read += end - start
+            else:
+                segments = iter_segments(FileRange(reader, start, end),
+                                         segment_types=self.segment_types(),
+                                         max_segment=self.max_segment)
+        if self.stats:
+            segments = self.stats.counted(segments)
+        return segments
+
+    def matches(self, FILE, start=0, end=None):
+        """Returns an iterator over the matches in FILE, see `scan`"""
+        matches = self.scan(self.segments(FILE, start, end))
+        if self.stats:
+            matches = self.stats.matched(matches)
+        return matches
+
+    def scan_plan(self):
+        """Returns the `ScanPlan` for the queries, filters and context
+
+        Segment types are mapped to the queries, filters and context
+        fields that use them, and to the number of splits needed.
+        Callers scanning many short runs of segments, such as one
+        message at a time, should prepare this once and pass it to
+        each `scan`.
+
+        """
+        queries = {}
+        for index, query in enumerate(self.queries):
+            queries.setdefault(query.segment, []).append(
+                (index, query.sequences))
+        filters = {}
+        for f in self.filters:
+            filters.setdefault(f.field.segment, []).append(f)
+        # captured context is kept by position, so each match's
+        # context is a copy of the list; whole fields are taken by
+        # index, sparing the call for the rest
+        fields = self.context_fields()
+        captures = {}
+        for position, ref in enumerate(fields):
+            whole = not ref.component and ref.width is None
+            captures.setdefault(ref.segment, []).append(
+                (position, ref.index, None if whole else ref))
+
+        # the number of splits each segment type needs, any fields
+        # beyond the last one used being left whole
+        splits = {'MSH': 10}
+        wanted = ([(query.segment, max(query.sequences))
+                   for query in self.queries] +
+                  [(f.field.segment, f.field.index) for f in self.filters] +
+                  [(ref.segment, ref.index) for ref in fields])
+        for segment_type, index in wanted:
+            splits[segment_type] = max(splits.get(segment_type, 0),
+                                       index + 1)
+        return ScanPlan(queries, filters, captures, splits, len(fields))
+
+    def scan(self, segments, plan=None):
+        """Generate (query index, context, values) for matching segments
+
+        :param segments: iterable of HL7 segments, in message order,
+          such as that returned from `iter_segments`
+        :param plan: the `ScanPlan` to use, prepared afresh if not
+          given
+
+        Every query is run against each segment, in a single pass.
+        The context is the list of requested values from the message,
+        in `context_columns` order, each taken from the most recent
+        segment of its type (see `context_fields`).  The values hold
+        an entry for each of the query's sequences, None for any
+        missing from the segment.  Matches without any displayable
+        value are skipped.  While any of the message's filters remain
+        undecided, its output is held back; once a filter fails, the
+        remaining segments of the message are skipped without being
+        split.  Segments are split on the delimiters declared by
+        their message's MSH segment.  Messages outside the `since`
+        and `until` window are skipped, as are those whose control id
+        `seen` (if set) reports as already seen.
+
+        """
+        if plan is None:
+            plan = self.scan_plan()
+        queries, filters, captures, splits = plan[:4]
+
+        TIME = ''
+        pending, skipping, held = dict(filters), False, []
+        empty = [''] * plan.width
+        captured = empty[:]
+        field, component = STANDARD_DELIMITERS[:2]
+        since, until = self.since, self.until
+        for l in segments:
+            kind = l[0:3]
+            split = splits.get(kind)
+            if split is None:
+                continue
+
+            # hang onto useful message header info and purge
+            # potentials from the previous message
+            if 'MSH' == kind:
+                field, component = delimiters(l)[:2]
+                sequences = l.split(field, split)
+                found = len(sequences)
+                TIME = sequences[6] if found > 6 else ''
+                # output held for the previous message failed a filter
+                pending, skipping, held = dict(filters), False, []
+                captured = empty[:]
+                if ((since and TIME[:len(since)] < since) or
+                        (until and TIME[:len(until)] > until) or
+                        (self.seen is not None and not self.seen.add(
+                            sequences[9] if found > 9 else ''))):
+                    skipping = True
+                    continue
+            elif skipping:
+                continue
+            else:
+                sequences = l.split(field, split)
+
+            # decide filters on the first segment of their type
+            if kind in pending:
+                if not all(f.matches(sequences, component) for f in
+                           pending.pop(kind)):
+                    skipping, held = True, []
+                    continue
+                if not pending:
+                    for found in held:
+                        yield found
+                    held = []
+
+            # hang onto values carried forward as context
+            if kind in captures:
+                for position, index, ref in captures[kind]:
+                    if ref is not None:
+                        captured[position] = ref.value(sequences, component)
+                    elif index < len(sequences):
+                        captured[position] = sequences[index]
+                    else:
+                        captured[position] = ''
+
+            # yield this out for each query it matches
+            matches = queries.get(kind)
+            if not matches:
+                continue
+            available = len(sequences)
+            for index, wanted in matches:
+                # segments never hold a newline, all three terminators
+                # having been split on
+                values = [sequences[e] if e < available else None
+                          for e in wanted]
+                if None in values:
+                    present = [v for v in values if v is not None]
+                    if not (len(present) > 1 or present and present[0]):
+                        continue
+                elif not (len(values) > 1 or values[0]):
+                    continue
+                if pending:
+                    held.append((index, captured[:], values))
+                else:
+                    yield index, captured[:], values
 
 def main():
     parser = Parser()
     parser.processArgs(sys.argv[1:])
-    parser.parse()
+    if parser.profile:
+        cProfile.runctx('parser.parse()', globals(), locals(),
+                        parser.profile)
+    else:
+        parser.parse()
 
 if __name__ == '__main__':
     main()
@@ -3,6 +3,27 @@ import gzip
 import os
 import zipfile
 
+#: Leading bytes identifying each supported zip protocol
+MAGIC_BYTES = (('gzip', '\x1f\x8b'), ('zip', 'PK\x03\x04'))
+
+
+def zip_protocol(filename):
+    """Returns the zip protocol used to compress filename, if any
+
+    :param filename: Full system path to the file to inspect
+
+    The protocol is recognized by the magic bytes at the start of the
+    file, not the filename suffix.  Returns 'gzip', 'zip' or None if
+    the file doesn't appear to be compressed.
+
+    """
+    with open(filename, 'rb') as fh:
+        head = fh.read(4)
+    for protocol, magic in MAGIC_BYTES:
+        if head.startswith(magic):
+            return protocol
+    return None
+
 
 def expand_file(filename=None, fileobj=None, zip_protocol=None,
                 output='stream'):
@@ -34,7 +55,7 @@ def expand_file(filename=None, fileobj=None, zip_protocol=None,
 
     def gzip_expand(filename, fileobj):
         if not fileobj:
-            fileobj = open(filename, 'rb')
+            return gzip.GzipFile(filename=filename, mode='rb')
         return gzip.GzipFile(fileobj=fileobj, mode='rb')
 
     def zip_expand(filename, fileobj):
@@ -66,6 +87,27 @@ def expand_file(filename=None, fileobj=None, zip_protocol=None,
     return desired_output(expander(filename, fileobj), output)
 
 
+def open_compressed(filename, zip_protocol='gzip', mode='wb'):
+    """Open filename for writing, compressing what is written
+
+    :param filename: Full system path of the file to write
+
+    :param zip_protocol: The zip protocol to use, only 'gzip' can be
+      written as a stream
+
+    :param mode: 'wb' to truncate, or 'ab' to append to the file
+
+    Appending adds another gzip member to the file, which gzip
+    readers, `expand_file` included, read as one stream.  Returns a
+    file like object, which the caller must close.
+
+    """
+    if zip_protocol != 'gzip':
+        raise ValueError("can't stream requested zip protocol: %s" %
+                         zip_protocol)
+    return gzip.open(filename, mode)
+
+
 def zip_file(filename, fileobj, zip_protocol):
     """Zip the file using the requested protocol
 
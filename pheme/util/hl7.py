@@ -0,0 +1,145 @@
+""" Lightweight, lazy access to HL7 messages for library use
+
+Messages are read with the same streaming machinery used by the
+HL7_segment_parser program.  Segments are kept as the raw string
+until a field is requested, and fields are only split into
+components when a component is requested, so callers only pay for
+what they look at.
+
+"""
+from pheme.util.HL7_segment_parser import delimiters, iter_segments
+from pheme.util.HL7_segment_parser import open_input, STANDARD_DELIMITERS
+
+
+class Segment(object):
+    """A single HL7 segment, split into fields on first access
+
+    Fields and components are numbered as in the HL7 standard,
+    starting from one.  For MSH segments, MSH-1 is the field
+    separator itself and MSH-2 the encoding characters.
+
+    """
+    __slots__ = ('raw', 'delimiters', '_fields')
+
+    def __init__(self, raw, delimiters=STANDARD_DELIMITERS):
+        self.raw = raw
+        self.delimiters = delimiters
+        self._fields = None
+
+    @property
+    def type(self):
+        """The three character segment type, i.e. 'PV1'"""
+        return self.raw[:3]
+
+    @property
+    def fields(self):
+        """List of the raw fields, including the segment type"""
+        if self._fields is None:
+            self._fields = self.raw.split(self.delimiters.field)
+            if self.type == 'MSH':
+                # MSH-1 is the field separator, not delimited by it
+                self._fields.insert(1, self.delimiters.field)
+        return self._fields
+
+    def field(self, sequence):
+        """Returns the field at sequence, or '' if not present"""
+        fields = self.fields
+        if 0 < sequence < len(fields):
+            return fields[sequence]
+        return ''
+
+    def component(self, sequence, component):
+        """Returns the component of the field at sequence
+
+        The field is split on the component separator for each call;
+        returns '' if either isn't present.
+
+        """
+        components = self.field(sequence).split(self.delimiters.component)
+        if 0 < component <= len(components):
+            return components[component - 1]
+        return ''
+
+    def __str__(self):
+        return self.raw
+
+    def __repr__(self):
+        return '<Segment %s>' % self.type
+
+
+class Message(object):
+    """An HL7 message, the list of segments from one MSH to the next"""
+    __slots__ = ('segments', 'filename')
+
+    def __init__(self, segments, filename=None):
+        """Create a message from its raw segments
+
+        :param segments: list of raw segment strings, the first being
+          the MSH segment
+        :param filename: optional name of the file containing the
+          message
+
+        """
+        shared = delimiters(segments[0])
+        self.segments = [Segment(raw, shared) for raw in segments]
+        self.filename = filename
+
+    @property
+    def header(self):
+        """The MSH segment"""
+        return self.segments[0]
+
+    def segment(self, segment_type):
+        """Returns the first segment of segment_type, or None"""
+        for segment in self.segments:
+            if segment.raw.startswith(segment_type):
+                return segment
+        return None
+
+    def segments_of(self, segment_type):
+        """Returns the list of all segments of segment_type"""
+        return [segment for segment in self.segments
+                if segment.raw.startswith(segment_type)]
+
+    def __str__(self):
+        return '\r'.join(segment.raw for segment in self.segments) + '\r'
+
+    def __repr__(self):
+        return '<Message %s>' % self.header.field(9)
+
+
+def group_messages(segments, filename=None):
+    """Generate a Message for each message among segments
+
+    :param segments: iterable of raw segments in file order, such as
+      that returned from `HL7_segment_parser.iter_segments`
+    :param filename: optional name of the file holding the segments
+
+    Only the current message is held in memory.  Any segments
+    preceding the first MSH are ignored.
+
+    """
+    pending = []
+    for raw in segments:
+        if raw.startswith('MSH'):
+            if pending:
+                yield Message(pending, filename)
+            pending = [raw]
+        elif pending:
+            pending.append(raw)
+    if pending:
+        yield Message(pending, filename)
+
+
+def iter_messages(path):
+    """Generate a Message for each message found in path
+
+    :param path: file containing HL7 messages, optionally gzip or zip
+      compressed
+
+    The file is streamed, see `group_messages`.
+
+    """
+    with open_input(path) as fileobj:
+        for message in group_messages(iter_segments(fileobj), path):
+            yield message
@@ -0,0 +1,203 @@
+""" Synthetic HL7 feeds and a throughput benchmark for HL7_segment_parser
+
+`write_corpus` generates a deterministic, realistic looking feed of
+ADT and ORU messages of any requested size.  The `benchmark` entry
+point writes a corpus in each of the segment terminator styles the
+parser understands and reports MB/s, messages/s and peak RSS for a
+`Parser.parse` run over each.
+
+"""
+import argparse
+from datetime import datetime, timedelta
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+from pheme.util.HL7_segment_parser import Parser
+
+#: Terminator styles benchmarked, by name
+STYLES = (('cr', '\r'), ('newline', '\n'), ('literal', '\\r'))
+
+FIRST_NAMES = ('JANE', 'JOHN', 'MARIA', 'WEI', 'AISHA', 'OMAR', 'EMMA',
+               'LIAM', 'PRIYA', 'NOAH', 'SOFIA', 'YUKI')
+LAST_NAMES = ('DOE', 'ROE', 'SMITH', 'GARCIA', 'NGUYEN', 'PATEL', 'KIM',
+              'JOHNSON', 'MULLER', 'OKAFOR', 'ROSSI', 'SILVA')
+DIAGNOSES = (('R50.9', 'FEVER'), ('J11.1', 'INFLUENZA'),
+             ('R05', 'COUGH'), ('A09', 'GASTROENTERITIS'),
+             ('S93.4', 'ANKLE SPRAIN'), ('R07.9', 'CHEST PAIN'))
+RESULTS = (('WBC', 'WHITE BLOOD COUNT', 'NM', '10*3/uL', (3.0, 15.0)),
+           ('HGB', 'HEMOGLOBIN', 'NM', 'g/dL', (9.0, 18.0)),
+           ('PLT', 'PLATELETS', 'NM', '10*3/uL', (100.0, 450.0)),
+           ('TEMP', 'BODY TEMPERATURE', 'NM', 'Cel', (35.5, 40.5)),
+           ('FLUA', 'INFLUENZA A AG', 'ST', '', None))
+PATIENT_CLASSES = (('E', 'Emergency'), ('I', 'Inpatient'),
+                   ('O', 'Outpatient'))
+EVENTS = ('A01', 'A03', 'A04', 'A08', 'A08', 'A08')
+
+
+def synthetic_messages(seed=0, start=datetime(2013, 1, 1)):
+    """Generate an endless, reproducible series of HL7 messages
+
+    :param seed: seed for the random choices, the same seed always
+      generates the same series
+    :param start: timestamp of the first message
+
+    Each message is a list of segments.  Roughly one in four is an
+    ORU^R01 lab result with an OBR and several OBX segments, the rest
+    ADT messages with EVN, PID, PV1 and DG1 segments.  Timestamps
+    increase from start, a few seconds apart.
+
+    """
+    generator = random.Random(seed)
+    when = start
+    control_id = 0
+    while True:
+        control_id += 1
+        when += timedelta(seconds=generator.randint(1, 30))
+        stamp = when.strftime('%Y%m%d%H%M%S')
+        patient = generator.randint(1, 50000)
+        visit = 'V%07d' % (patient * 7 + generator.randint(0, 6))
+        patient_class = generator.choice(PATIENT_CLASSES)
+        oru = generator.random() < 0.25
+        if oru:
+            message_type = 'ORU^R01'
+        else:
+            event = generator.choice(EVENTS)
+            message_type = 'ADT^' + event
+
+        segments = [
+            '|'.join(('MSH', '^~\\&', 'SENDAPP', 'FAC%02d' %
+                      generator.randint(1, 20), 'PHEME', 'STATE', stamp,
+                      '', message_type, 'MSG%09d' % control_id, 'P',
+                      '2.5.1'))]
+        if not oru:
+            segments.append('|'.join(('EVN', event, stamp)))
+        pid = ['PID', '1', '', '%d^^^FAC^MR' % patient, '',
+               '%s^%s' % (generator.choice(LAST_NAMES),
+                          generator.choice(FIRST_NAMES)),
+               '', '%04d%02d%02d' % (generator.randint(1920, 2012),
+                                     generator.randint(1, 12),
+                                     generator.randint(1, 28)),
+               generator.choice('MFU')] + [''] * 9 + [visit]
+        segments.append('|'.join(pid))
+        segments.append('|'.join(('PV1', '1', '^'.join(patient_class),
+                                  'WARD^%d' % generator.randint(1, 40))))
+        if oru:
+            segments.append('|'.join(('OBR', '1', '', 'LAB%09d' %
+                                      control_id, 'PANEL^LAB PANEL',
+                                      '', '', stamp)))
+            for set_id in range(1, generator.randint(2, 8)):
+                code, name, value_type, units, bounds = \
+                    generator.choice(RESULTS)
+                if bounds:
+                    value = '%.1f' % generator.uniform(*bounds)
+                else:
+                    value = generator.choice(('POSITIVE', 'NEGATIVE'))
+                segments.append('|'.join((
+                    'OBX', str(set_id), value_type, '%s^%s' % (code, name),
+                    '', value, units, '', '', '', '', 'F', '', '', stamp)))
+        else:
+            for set_id in range(1, generator.randint(1, 3)):
+                segments.append('|'.join((
+                    'DG1', str(set_id), 'I10', '^'.join(
+                        generator.choice(DIAGNOSES)), '', stamp, 'W')))
+        yield segments
+
+
+def write_corpus(fileobj, size, terminator='\r', seed=0):
+    """Write synthetic messages to fileobj until size bytes are reached
+
+    :param fileobj: file like object to write to
+    :param size: minimum number of bytes to write, the final message
+      is always written whole
+    :param terminator: segment terminator, one of those understood by
+      `HL7_segment_parser.iter_segments`
+    :param seed: seed for `synthetic_messages`
+
+    Returns the number of messages written.
+
+    """
+    written = count = 0
+    for segments in synthetic_messages(seed):
+        if written >= size:
+            break
+        message = terminator.join(segments) + terminator
+        fileobj.write(message)
+        written += len(message)
+        count += 1
+    return count
+
+
+def _measure(argv, results):
+    """Run a Parser in a child process, reporting back via results
+
+    Running each measurement in its own process keeps the peak RSS
+    reported (in kilobytes) specific to that run.
+
+    """
+    parser = Parser()
+    parser.processArgs(argv)
+    for query in parser.queries:
+        query.output = os.devnull
+    begin = time.time()
+    parser.parse()
+    results.put((time.time() - begin,
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def measure(argv):
+    """Returns (elapsed seconds, peak RSS in kilobytes) for a Parser
+    run with argv, all query output going to os.devnull"""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(argv, results))
+    process.start()
+    found = results.get()
+    process.join()
+    return found
+
+
+def benchmark():
+    """Entry point to benchmark HL7_segment_parser throughput
+
+    Writes a corpus of the requested size for each terminator style,
+    then times a parse of each with the given parser arguments.
+
+    """
+    a = argparse.ArgumentParser(description="benchmark HL7_segment_parser "
+                                "over synthetic feeds")
+    a.add_argument('--size', type=float, default=64,
+                   help="corpus size in MB (default %(default)s)")
+    a.add_argument('--seed', type=int, default=0,
+                   help="seed for the synthetic messages")
+    a.add_argument('--dir', help="directory for the corpus files, "
+                   "removed after the run unless given")
+    a.add_argument('parser_args', nargs=argparse.REMAINDER,
+                   help="HL7_segment_parser options and query, the "
+                   "corpus file is appended (default: -atvp PV1 2,3)")
+    args = a.parse_args()
+    parser_args = args.parser_args or ['-atvp', 'PV1', '2,3']
+    if parser_args[0] == '--':
+        parser_args = parser_args[1:]
+
+    directory = args.dir or tempfile.mkdtemp(prefix='hl7_benchmark')
+    try:
+        print '%-8s %8s %10s %8s %12s %12s' % (
+            'style', 'MB', 'messages', 'MB/s', 'messages/s', 'peak RSS KB')
+        for style, terminator in STYLES:
+            filename = os.path.join(directory, 'corpus_%s.hl7' % style)
+            with open(filename, 'wb') as corpus:
+                count = write_corpus(corpus, int(args.size * (1 << 20)),
+                                     terminator, args.seed)
+            megabytes = os.path.getsize(filename) / float(1 << 20)
+            elapsed, peak = measure(parser_args + [filename])
+            elapsed = max(elapsed, 1e-6)
+            print '%-8s %8.1f %10d %8.1f %12d %12d' % (
+                style, megabytes, count, megabytes / elapsed,
+                count / elapsed, peak)
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory)
@@ -0,0 +1,315 @@
+""" Append-only store of HL7 messages, indexed by visit id (PID-18)
+
+A store is a directory holding `messages.hl7`, to which every message
+is appended with carriage return terminated segments, and a number of
+sorted index runs.  Each run has a line per message of a batch added,
+'visit id<TAB>MSH-7<TAB>offset<TAB>length', sorted by visit id and
+then time.  A lookup binary searches each run for the visit, so costs
+O(log n) seeks per run plus reading just the matching messages.
+
+Every batch added writes a new run, and once there are more than
+`MAX_RUNS` they are merged into one.  Files fed to the store are
+remembered, so adding a file again only adds the messages since
+appended to it.  Adds and merges hold a lock on the store, so several
+processes may feed the same store.
+
+"""
+import argparse
+import glob
+import hashlib
+import heapq
+import os
+import sys
+
+from pheme.util.hl7 import Message, group_messages
+from pheme.util.HL7_segment_parser import FileRange, iter_segments
+from pheme.util.HL7_segment_parser import appended_range, open_input
+from pheme.util.HL7_segment_parser import load_checkpoint, save_checkpoint
+from pheme.util.HL7_segment_parser import zip_protocol
+from pheme.util.lock import Lock
+
+#: Name of the file in the store directory holding the messages
+DATA_FILE = 'messages.hl7'
+
+#: Prefix of the index run files in the store directory
+RUN_PREFIX = 'index.'
+
+#: Name of the file recording the offsets reached in each file added
+SOURCES_FILE = 'sources.json'
+
+#: Runs are merged into one once there are more than this many
+MAX_RUNS = 16
+
+#: Messages added are indexed in runs of at most this many
+RUN_SIZE = 1 << 20
+
+#: Seconds a file must go unmodified before its last message is
+#: taken as complete
+QUIET_INTERVAL = 5.0
+
+
+def _clean(value):
+    """Returns value safe to write as a field of an index line"""
+    return value.replace('\t', ' ').replace('\n', ' ').replace('\r', ' ')
+
+
+def _seek_first(index, target):
+    """Position index at the first line sorting at or after target
+
+    :param index: open index run, its lines in sorted order
+    :param target: string to compare the lines against
+
+    Binary searches the byte offsets of the file, reading only the
+    line found at each step.
+
+    """
+    index.seek(0, os.SEEK_END)
+    low, high = 0, index.tell()
+    while low < high:
+        middle = (low + high) // 2
+        # the first line beginning at or after middle
+        if middle:
+            index.seek(middle - 1)
+            index.readline()
+        else:
+            index.seek(0)
+        line = index.readline()
+        if line and line < target:
+            low = middle + 1
+        else:
+            high = middle
+    if low:
+        index.seek(low - 1)
+        index.readline()
+    else:
+        index.seek(0)
+
+
+class MessageStore(object):
+    """An append-only, visit indexed message store in a directory"""
+
+    def __init__(self, directory, max_runs=MAX_RUNS,
+                 interval=QUIET_INTERVAL):
+        """Open the store in directory, creating it if need be
+
+        :param directory: path of the store directory
+        :param max_runs: number of index runs above which they are
+          merged into one
+        :param interval: seconds a file added must go unmodified
+          before its last message is taken as complete
+
+        """
+        self.directory = directory
+        self.max_runs = max_runs
+        self.interval = interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.data = os.path.join(directory, DATA_FILE)
+        self.sources = os.path.join(directory, SOURCES_FILE)
+        self.lock = Lock('hl7_store.%s' % hashlib.md5(
+            os.path.abspath(directory)).hexdigest())
+
+    def runs(self):
+        """Returns the paths of the index runs, oldest first"""
+        return sorted(glob.glob(os.path.join(self.directory,
+                                             RUN_PREFIX + '*[0-9]')))
+
+    def add_messages(self, messages):
+        """Append messages to the store, returns the number added
+
+        :param messages: iterable of `hl7.Message`
+
+        Messages without a visit id are skipped.  The messages are
+        written before the run indexing them, so an interrupted add
+        leaves at worst some unindexed, invisible messages behind.
+
+        """
+        self.lock.acquire()
+        try:
+            return self._add_messages(messages)
+        finally:
+            self.lock.release()
+
+    def _add_messages(self, messages):
+        """`add_messages`, with the lock held"""
+        added = 0
+        records = []
+        with open(self.data, 'ab') as data:
+            data.seek(0, os.SEEK_END)
+            offset = data.tell()
+            for message in messages:
+                pid = message.segment('PID')
+                visit = pid.field(18) if pid else ''
+                if not visit:
+                    continue
+                raw = str(message)
+                data.write(raw)
+                records.append('%s\t%s\t%d\t%d\n' % (
+                    _clean(visit), _clean(message.header.field(7)),
+                    offset, len(raw)))
+                offset += len(raw)
+                added += 1
+                if len(records) >= RUN_SIZE:
+                    self.write_run(data, records)
+                    records = []
+            self.write_run(data, records)
+        if len(self.runs()) > self.max_runs:
+            self._compact()
+        return added
+
+    def write_run(self, data, records):
+        """Sync data, then write the index lines records as a new run"""
+        if not records:
+            return
+        data.flush()
+        os.fsync(data.fileno())
+        records.sort()
+        self._write_run(records)
+
+    def _write_run(self, lines):
+        """Write the sorted lines as the newest run, returns its path"""
+        runs = self.runs()
+        number = int(runs[-1][-6:]) + 1 if runs else 0
+        name = os.path.join(self.directory, RUN_PREFIX + '%06d' % number)
+        with open(name + '.tmp', 'wb') as run:
+            run.writelines(lines)
+        os.rename(name + '.tmp', name)
+        return name
+
+    def compact(self):
+        """Merge all the index runs into one
+
+        The runs are merged as streams, so memory use doesn't grow
+        with the size of the index.  The merged run is in place
+        before the old ones are removed; lookups ignore the
+        duplicates an interruption in between would leave.
+
+        """
+        self.lock.acquire()
+        try:
+            self._compact()
+        finally:
+            self.lock.release()
+
+    def _compact(self):
+        """`compact`, with the lock held"""
+        runs = self.runs()
+        if len(runs) < 2:
+            return
+        files = [open(run, 'rb') for run in runs]
+        try:
+            self._write_run(heapq.merge(*files))
+        finally:
+            for run in files:
+                run.close()
+        for run in runs:
+            os.remove(run)
+
+    def add_file(self, filename):
+        """Add the messages from filename, returns the number added
+
+        Only the messages appended since filename was last added are
+        read, starting over should it be truncated or replaced.  The
+        last message is taken as complete once the file ends with a
+        segment terminator and hasn't been modified for `interval`
+        seconds, otherwise it is left for a later add, as its writer
+        may not be done with it.  Compressed files are read whole,
+        again only if they change.
+
+        """
+        self.lock.acquire()
+        try:
+            return self._add_file(filename)
+        finally:
+            self.lock.release()
+
+    def _add_file(self, filename):
+        """`add_file`, with the lock held"""
+        sources = load_checkpoint(self.sources)
+        key = os.path.abspath(filename)
+        appended = appended_range(filename, sources.get(key, (0, None)),
+                                  self.interval)
+        if appended is None:
+            return 0
+        start, end, inode = appended
+        with open_input(filename) as FILE:
+            if zip_protocol(filename):
+                segments = iter_segments(FILE)
+            else:
+                segments = iter_segments(FileRange(FILE, start, end))
+            added = self._add_messages(group_messages(segments,
+                                                      filename))
+        sources[key] = (end, inode)
+        save_checkpoint(self.sources, sources)
+        return added
+
+    def lookup(self, visit, since=None, until=None):
+        """Generate the messages for visit, in time (MSH-7) order
+
+        :param visit: the visit id, PID-18
+        :param since: if given, only messages with MSH-7 at or after
+          since, comparing as many leading characters as given
+        :param until: if given, only messages with MSH-7 at or before
+          until, likewise
+
+        """
+        found = set()
+        # runs may be merged away while being read, but the messages
+        # themselves are only ever appended to
+        self.lock.acquire()
+        try:
+            for run in self.runs():
+                with open(run, 'rb') as index:
+                    _seek_first(index, '%s\t%s' % (visit, since or ''))
+                    for line in index:
+                        fields = line.rstrip('\n').split('\t')
+                        if fields[0] != visit:
+                            break
+                        if until and fields[1][:len(until)] > until:
+                            break
+                        found.add((fields[1], int(fields[2]),
+                                   int(fields[3])))
+        finally:
+            self.lock.release()
+        if not found:
+            return
+        with open(self.data, 'rb') as data:
+            for when, offset, length in sorted(found):
+                data.seek(offset)
+                raw = data.read(length)
+                yield Message(raw.rstrip('\r').split('\r'), self.data)
+
+
+def main():
+    """Entry point to add files to, or look up visits in, a store"""
+    a = argparse.ArgumentParser(description="append-only HL7 message "
+                                "store indexed by visit id (PID-18)")
+    a.add_argument('store', help="store directory, created if need be")
+    commands = a.add_subparsers(dest='command')
+    add = commands.add_parser('add', help="add the messages from files, "
+                              "only those since appended for files "
+                              "added before")
+    add.add_argument('files', nargs='+', help="files to add, optionally "
+                     "gzip or zip compressed")
+    add.add_argument('--interval', type=float, default=QUIET_INTERVAL,
+                     help="seconds a file must go unmodified before its "
+                     "last message is taken as complete (default "
+                     "%(default)s)")
+    get = commands.add_parser('get', help="write the messages for a "
+                              "visit to stdout, in time order")
+    get.add_argument('visit', help="visit id, as found in PID-18")
+    get.add_argument('--since', help="only messages with MSH-7 at or "
+                     "after this time, i.e. 20130101")
+    get.add_argument('--until', help="only messages with MSH-7 at or "
+                     "before this time")
+    args = a.parse_args()
+
+    store = MessageStore(args.store,
+                         interval=getattr(args, 'interval', QUIET_INTERVAL))
+    if args.command == 'add':
+        for filename in args.files:
+            print "%s: %d messages added" % (filename,
+                                             store.add_file(filename))
+    else:
+        for message in store.lookup(args.visit, args.since, args.until):
+            sys.stdout.write(str(message))
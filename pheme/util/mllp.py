@@ -0,0 +1,213 @@
+""" MLLP listener applying HL7_segment_parser queries to live feeds
+
+Messages arrive framed by the Minimal Lower Layer Protocol, a start
+block character (0x0b) before and an end block and carriage return
+(0x1c 0x0d) after each message.  Every sender connection is served by
+its own thread, which acknowledges each message as soon as it has been
+queued.  A single writer thread applies the Parser queries and writes
+the matches, so a slow output never holds up a sender's ACK.
+
+"""
+import argparse
+from cStringIO import StringIO
+from datetime import datetime
+import logging
+import Queue
+import SocketServer
+import threading
+
+from pheme.util.HL7_segment_parser import Parser, SeenSet, delimiters
+from pheme.util.HL7_segment_parser import iter_segments
+
+START_BLOCK = '\x0b'
+END_BLOCK = '\x1c\r'
+
+
+def iter_frames(read, chunk_size=4096, max_message=None):
+    """Generate the messages framed within an MLLP byte stream
+
+    :param read: callable returning up to the requested number of
+      bytes, and '' at the end of the stream, i.e. socket.recv
+    :param chunk_size: number of bytes to request at a time
+    :param max_message: if given, messages are truncated to this
+      many bytes; the rest of a longer message is dropped as it is
+      received, so is never held in memory
+
+    Any bytes outside of the start and end blocks are discarded, as
+    is an incomplete message at the end of the stream.
+
+    """
+    pending = ''
+    search_from = 0
+    # the start of an oversized message, while its rest is dropped
+    head = None
+    while True:
+        if head is not None:
+            end = pending.find(END_BLOCK)
+            if end >= 0:
+                yield head
+                head = None
+                pending = pending[end + len(END_BLOCK):]
+                continue
+            # keep what may be the first half of the end block
+            pending = pending[1 - len(END_BLOCK):]
+        else:
+            start = pending.find(START_BLOCK)
+            if start >= 0:
+                end = pending.find(END_BLOCK, max(start + 1, search_from))
+                if end >= 0:
+                    stop = end
+                    if max_message:
+                        stop = min(end, start + 1 + max_message)
+                    yield pending[start + 1:stop]
+                    pending = pending[end + len(END_BLOCK):]
+                    search_from = 0
+                    continue
+                if max_message and len(pending) - start - 1 > max_message:
+                    cut = start + 1 + max_message
+                    head, pending = pending[start + 1:cut], pending[cut:]
+                    search_from = 0
+                    continue
+                # only the newly read bytes need searching next time
+                search_from = max(len(pending) - len(END_BLOCK) + 1, 0)
+            else:
+                pending, search_from = '', 0
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+
+
+def ack(message, code='AA'):
+    """Returns an acknowledgement for message
+
+    :param message: the raw message being acknowledged
+    :param code: acknowledgement code for MSA-1, 'AA' for accept
+
+    The sending and receiving application and facility of the
+    message header are swapped, and MSA-2 echoes its control id.
+
+    """
+    msh = message.split('\r', 1)[0]
+    if not msh.startswith('MSH'):
+        msh, code = 'MSH|^~\\&', 'AR'
+    found = delimiters(msh)
+    fields = msh.split(found.field) + [''] * 12
+    message_type = fields[8].split(found.component)
+    trigger = message_type[1] if len(message_type) > 1 else ''
+    header = found.field.join((
+        'MSH', fields[1], fields[4], fields[5], fields[2], fields[3],
+        datetime.now().strftime('%Y%m%d%H%M%S'), '',
+        found.component.join(('ACK', trigger)), 'ACK' + fields[9],
+        fields[10] or 'P', fields[11]))
+    return header + '\r' + found.field.join(('MSA', code, fields[9])) + '\r'
+
+
+class MLLPHandler(SocketServer.BaseRequestHandler):
+    """Receives the messages from one sender connection"""
+
+    def handle(self):
+        peer = '%s:%d' % self.client_address[:2]
+        for message in iter_frames(self.request.recv,
+                                   max_message=self.server.max_message):
+            self.server.received.put((peer, message))
+            self.request.sendall(START_BLOCK + ack(message) + END_BLOCK)
+
+
+class MLLPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Threaded MLLP server writing the matches of a Parser's queries
+
+    The matches are written with the Parser's output settings.  The
+    sender's address stands in for the filename in the file column
+    of the structured formats.  Fields are truncated to the Parser's
+    `max_segment`, if set.
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, parser, max_message=None):
+        """Bind to address and start the writer thread
+
+        :param address: (host, port) to listen on, port 0 for any
+        :param parser: Parser with its queries and output configured
+        :param max_message: if given, messages are truncated to this
+          many bytes as they are received, see `iter_frames`
+
+        """
+        SocketServer.TCPServer.__init__(self, address, MLLPHandler)
+        self.parser = parser
+        self.max_message = max_message
+        if parser.dedup:
+            parser.seen = SeenSet(parser.dedup_capacity)
+        self.received = Queue.Queue()
+        self.writers = parser.open_outputs()
+        self.writer = threading.Thread(target=self.write_matches)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def write_matches(self):
+        """Writer thread, scanning each queued message for matches
+
+        Output is flushed whenever the queue empties, so matches
+        appear promptly without a write per message under load.
+
+        """
+        plan = self.parser.scan_plan()
+        while True:
+            received = self.received.get()
+            if received is None:
+                break
+            peer, message = received
+            try:
+                for index, context, values in self.parser.scan(
+                        iter_segments(StringIO(message),
+                                      max_segment=self.parser.max_segment),
+                        plan):
+                    self.writers[index].write(peer, context, values)
+            except Exception:
+                logging.exception("failed scanning message from %s", peer)
+            if self.received.empty():
+                for output in self.parser.buffers(self.writers):
+                    output.flush()
+
+    def server_close(self):
+        """Stop listening, then write any queued matches and close
+        the outputs"""
+        SocketServer.TCPServer.server_close(self)
+        self.received.put(None)
+        self.writer.join()
+        for output in self.parser.buffers(self.writers):
+            output.close()
+
+
+def main():
+    """Entry point to apply HL7_segment_parser queries to an MLLP feed
+
+    Takes the HL7_segment_parser options and query, less the files.
+
+    """
+    a = argparse.ArgumentParser(
+        description="apply HL7_segment_parser queries to messages "
+        "received over MLLP; any other arguments are passed on to "
+        "HL7_segment_parser, less the files to parse")
+    a.add_argument('--host', default='localhost',
+                   help="address to listen on (default %(default)s)")
+    a.add_argument('--port', type=int, default=2575,
+                   help="port to listen on (default %(default)s)")
+    a.add_argument('--max-message', type=int, metavar='BYTES',
+                   help="truncate messages longer than BYTES as they "
+                   "are received")
+    args, parser_args = a.parse_known_args()
+    parser = Parser()
+    parser.processArgs(parser_args, require_files=False)
+    if parser.count:
+        a.error("--count isn't supported on a live feed")
+
+    server = MLLPServer((args.host, args.port), parser, args.max_message)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,59 @@
+""" Bulk load of HL7_segment_parser matches into PostgreSQL via COPY
+
+Rather than an INSERT per row, matches are streamed into their table
+with COPY, a batch at a time.  The batching itself is left to the
+`HL7_segment_parser.OutputBuffer` wrapped around each `CopyStream`,
+which bounds the rows held in memory.
+
+"""
+from cStringIO import StringIO
+import psycopg2
+
+from pheme.util.pg_access import db_params
+
+
+class CopyStream(object):
+    """File like target loading rows into a table
+
+    Each write is sent with a single COPY, and each flush commits, so
+    an OutputBuffer around the stream loads and commits batches of
+    its size.  After a failure, `rollback` discards the open batch,
+    leaving only the batches already committed.  Data written must be
+    in PostgreSQL's COPY text format, as produced by RowWriter's
+    'copy' format, with columns in the table's column order.
+
+    """
+
+    def __init__(self, section, table, host='localhost'):
+        """Connect to the database
+
+        :param section: block of config file to use for connection
+          details, see `pg_access.db_params`
+        :param table: name of the table to load, optionally schema
+          qualified
+        :param host: database host
+
+        """
+        self.table = table
+        self.connection = psycopg2.connect(host=host, **db_params(section))
+        self.cursor = self.connection.cursor()
+
+    def write(self, data):
+        if data:
+            self.cursor.copy_expert('COPY %s FROM STDIN' % self.table,
+                                    StringIO(data))
+
+    def flush(self):
+        self.connection.commit()
+
+    def close(self):
+        """Commit any rows outstanding and disconnect"""
+        self.connection.commit()
+        self.cursor.close()
+        self.connection.close()
+
+    def rollback(self):
+        """Roll back the rows of the open batch and disconnect"""
+        self.connection.rollback()
+        self.cursor.close()
+        self.connection.close()
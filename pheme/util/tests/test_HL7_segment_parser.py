@@ -0,0 +1,1081 @@
+#!/usr/bin/env python
+""" Unit tests for the HL7_segment_parser module.
+
+"""
+from array import array
+from cStringIO import StringIO
+import os
+import pstats
+import shutil
+import sys
+import unittest
+from tempfile import NamedTemporaryFile, mkdtemp
+
+from pheme.util.compression import expand_file, zip_file
+from pheme.util import HL7_segment_parser
+from pheme.util.HL7_segment_parser import FieldRef, Filter, SeenSet
+from pheme.util.HL7_segment_parser import Parser, iter_segments, main
+from pheme.util.HL7_segment_parser import RowWriter, SpillingCounter
+from pheme.util.HL7_segment_parser import shard_name, truncate_fields
+from pheme.util.HL7_segment_parser import iter_mapped_segments
+from pheme.util.HL7_segment_parser import message_boundary
+from pheme.util.HL7_segment_parser import index_filename, load_index
+from pheme.util.HL7_segment_parser import times_filename, load_time_range
+from pheme.util.HL7_segment_parser import last_message_boundary
+from pheme.util.HL7_segment_parser import appended_range, load_checkpoint
+from pheme.util.HL7_segment_parser import load_manifest
+from pheme.util.HL7_segment_parser import matches_filename, save_matches
+
+MESSAGES = (
+    ['MSH|^~\\&|SEND|FAC|RECV|FAC|201301011200||ADT^A04|1001|P|2.3',
+     'EVN|A04|201301011200',
+     'PID|1||123^^^MRN||DOE^JANE||19700101|F' + '|' * 10 + 'V100',
+     'PV1|1|E^Emergency|ED'],
+    ['MSH|^~\\&|SEND|FAC|RECV|FAC|201301021300||ADT^A08|1002|P|2.3',
+     'EVN|A08|201301021300',
+     'PID|1||456^^^MRN||ROE^JOHN||19800202|M' + '|' * 10 + 'V200',
+     'PV1|1|I^Inpatient|4W'],
+)
+
+
+def feed(terminator='\r', messages=MESSAGES):
+    """Returns the messages as a single feed using terminator"""
+    return terminator.join(
+        [terminator.join(message) for message in messages]) + terminator
+
+
+class HL7TestFile(unittest.TestCase):
+    """Manages creation and clean up of test feed files"""
+    def setUp(self):
+        super(HL7TestFile, self).setUp()
+        self.tempfiles = []
+
+    def tearDown(self):
+        super(HL7TestFile, self).tearDown()
+        for filename in self.tempfiles:
+            for created in (filename, index_filename(filename),
+                            times_filename(filename)):
+                if os.path.exists(created):
+                    os.remove(created)
+
+    def create_test_file(self, content):
+        """Write content to a temporary file, returns the filename"""
+        with NamedTemporaryFile(prefix='unittest', suffix='.hl7',
+                                delete=False) as tempfile:
+            tempfile.write(content)
+        self.tempfiles.append(tempfile.name)
+        return tempfile.name
+
+    def compress_test_file(self, filename, zip_protocol):
+        """Compress filename with zip_protocol, returns the new name"""
+        compressed = zip_file(filename, open(filename, 'rb'), zip_protocol)
+        self.tempfiles.append(compressed)
+        return compressed
+
+    def parse(self, *argv):
+        """Run a Parser over argv, returns the lines of output"""
+        parser = Parser()
+        parser.processArgs(list(argv))
+        return self.parse_stdout(parser).splitlines()
+
+    def parse_stdout(self, parser):
+        """Run parser.parse(), returns what it wrote to stdout"""
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            parser.parse()
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+
+class TestIterSegments(unittest.TestCase):
+
+    def test_terminators(self):
+        expected = MESSAGES[0] + MESSAGES[1]
+        for terminator in ('\r', '\n', '\\r', '\r\n'):
+            found = list(iter_segments(StringIO(feed(terminator))))
+            self.assertEqual(found, expected)
+
+    def test_small_chunks(self):
+        # chunk boundaries will land mid segment and mid '\\r'
+        expected = MESSAGES[0] + MESSAGES[1]
+        for chunk_size in (1, 2, 3, 7):
+            found = list(iter_segments(StringIO(feed('\\r')),
+                                       chunk_size=chunk_size))
+            self.assertEqual(found, expected)
+
+    def test_segment_types(self):
+        found = list(iter_segments(StringIO(feed('\\r')), chunk_size=5,
+                                   segment_types=set(['MSH', 'PV1'])))
+        self.assertEqual(found, [MESSAGES[0][0], MESSAGES[0][3],
+                                 MESSAGES[1][0], MESSAGES[1][3]])
+        found = list(iter_segments(StringIO('MSH|^~\\&\rPID|1'),
+                                   segment_types=set(['PID'])))
+        self.assertEqual(found, ['PID|1'])
+
+    def test_unterminated(self):
+        found = list(iter_segments(StringIO('MSH|^~\\&\rPID|1')))
+        self.assertEqual(found, ['MSH|^~\\&', 'PID|1'])
+
+    def test_max_segment(self):
+        long = 'OBX|1|ED|PDF||' + 'A' * 100 + '||||||F'
+        custom = [segment.replace('|', '#') for segment in
+                  MESSAGES[1] + [long]]
+        content = feed('\\r', [MESSAGES[0] + [long, 'NTE|1'], custom])
+        short = 'OBX|1|ED|PDF||' + 'A' * 12 + '||||||F'
+        expected = (MESSAGES[0] + [short, 'NTE|1'] +
+                    [segment.replace('|', '#') for segment in
+                     MESSAGES[1] + [short]])
+        for chunk_size in (1, 5, 16, 1 << 20):
+            found = list(iter_segments(StringIO(content),
+                                       chunk_size=chunk_size,
+                                       max_segment=12))
+            self.assertEqual(found, [truncate_fields(segment, segment[3], 12)
+                                     for segment in expected])
+            self.assertEqual(found[4], short)
+
+
+class TestMappedSegments(HL7TestFile):
+
+    def test_terminators(self):
+        expected = [MESSAGES[0][0], MESSAGES[0][3],
+                    MESSAGES[1][0], MESSAGES[1][3]]
+        for terminator in ('\r', '\n', '\\r', '\r\n'):
+            filename = self.create_test_file(feed(terminator))
+            with open(filename, 'rb') as fh:
+                found = list(iter_mapped_segments(fh, ('MSH', 'PV1')))
+            self.assertEqual(found, expected)
+
+    def test_embedded_tags(self):
+        # tags inside values don't start a segment
+        messages = [[segment + '|PV1 MSH' for segment in message]
+                    for message in MESSAGES]
+        for terminator in ('\r', '\\r'):
+            filename = self.create_test_file(feed(terminator, messages))
+            with open(filename, 'rb') as fh:
+                found = list(iter_mapped_segments(fh, ('MSH', 'PV1')))
+            self.assertEqual(found, [messages[0][0], messages[0][3],
+                                     messages[1][0], messages[1][3]])
+
+    def test_range(self):
+        content = feed()
+        second = content.index('MSH', 1)
+        filename = self.create_test_file(content)
+        with open(filename, 'rb') as fh:
+            self.assertEqual(
+                list(iter_mapped_segments(fh, ('EVN',), 0, second)),
+                [MESSAGES[0][1]])
+            self.assertEqual(
+                list(iter_mapped_segments(fh, ('EVN',), second)),
+                [MESSAGES[1][1]])
+
+    def test_empty(self):
+        filename = self.create_test_file('')
+        with open(filename, 'rb') as fh:
+            self.assertEqual(list(iter_mapped_segments(fh, ('MSH',))), [])
+
+
+class TestParser(HL7TestFile):
+
+    def test_sequences(self):
+        filename = self.create_test_file(feed())
+        self.assertEqual(self.parse('PV1', '2,3', filename),
+                         ['E^Emergency|ED', 'I^Inpatient|4W'])
+
+    def test_msh_sequences(self):
+        filename = self.create_test_file(feed('\n'))
+        self.assertEqual(self.parse('MSH', '9,10', filename),
+                         ['ADT^A04|1001', 'ADT^A08|1002'])
+
+    def test_context(self):
+        filename = self.create_test_file(feed())
+        self.assertEqual(self.parse('-atvp', 'EVN', '1', filename),
+                         ['::ADT^A04:201301011200:A04',
+                          '::ADT^A08:201301021300:A08'])
+        self.assertEqual(self.parse('-atvp', 'PV1', '3', filename),
+                         ['V100:E:ADT^A04:201301011200:ED',
+                          'V200:I:ADT^A08:201301021300:4W'])
+
+    def test_mmap(self):
+        for terminator in ('\r', '\n', '\\r'):
+            filename = self.create_test_file(feed(terminator))
+            for argv in (('PV1', '2,3'), ('-atvp', 'EVN', '1'),
+                         ('-atvp', 'MSH', '10')):
+                argv += (filename,)
+                self.assertEqual(self.parse('--mmap', *argv),
+                                 self.parse(*argv))
+
+
+class TestIndex(HL7TestFile):
+
+    def test_load_index(self):
+        content = feed('\\r')
+        filename = self.create_test_file(content)
+        index = load_index(filename, ('MSH', 'PV1', 'ZZZ'))
+        self.assertTrue(os.path.exists(index_filename(filename)))
+        self.assertEqual(sorted(index.keys()), ['MSH', 'PV1', 'ZZZ'])
+        self.assertEqual(index['ZZZ'], (array('L'), array('L')))
+        self.assertEqual([content[o:o + l] for o, l in zip(*index['PV1'])],
+                         [MESSAGES[0][3], MESSAGES[1][3]])
+        self.assertEqual(list(index['MSH'][0]), [0, content.index('MSH', 1)])
+
+    def test_stale_index(self):
+        filename = self.create_test_file(feed())
+        self.assertEqual(self.parse('-i', 'PV1', '3', filename),
+                         ['ED', '4W'])
+        with open(filename, 'ab') as fh:
+            fh.write(feed(messages=MESSAGES[:1]))
+        self.assertEqual(len(load_index(filename, ('MSH',))['MSH'][0]), 3)
+        self.assertEqual(self.parse('-i', 'PV1', '3', filename),
+                         ['ED', '4W', 'ED'])
+
+    def test_index(self):
+        for terminator in ('\r', '\n', '\\r'):
+            filename = self.create_test_file(feed(terminator))
+            for argv in (('PV1', '2,3'), ('-atvp', 'EVN', '1'),
+                         ('-atvp', 'MSH', '10')):
+                argv += (filename,)
+                self.assertEqual(self.parse('--index', *argv),
+                                 self.parse(*argv))
+
+    def test_glob_sidecars(self):
+        directory = mkdtemp(prefix='unittest')
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'a.hl7'), 'wb') as fh:
+            fh.write(feed())
+        for run in range(2):
+            self.assertEqual(self.parse('-i', 'PV1', '3',
+                                        os.path.join(directory, '*')),
+                             ['ED', '4W'])
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['a.hl7', 'a.hl7.idx'])
+
+
+    def test_unwritable_index(self):
+        filename = self.create_test_file(feed(messages=MESSAGES * 3))
+        # as if the archive directory were read only
+        unwritable = lambda filename: os.path.join(
+            filename + '.missing', 'sidecar')
+        original = HL7_segment_parser.index_filename
+        HL7_segment_parser.index_filename = unwritable
+        try:
+            self.assertRaises(IOError, load_index, filename, ('PV1',))
+            self.assertEqual(self.parse('--index', 'PV1', '3', filename),
+                             ['ED', '4W'] * 3)
+            parser = Parser()
+            parser.processArgs(['--index', '--jobs', '2', 'PV1', '3',
+                                filename])
+            parser.split_size = 100
+            self.assertEqual(sorted(self.parse_stdout(parser).splitlines()),
+                             ['4W'] * 3 + ['ED'] * 3)
+        finally:
+            HL7_segment_parser.index_filename = original
+
+    def test_checkpoint_rejected(self):
+        filename = self.create_test_file(feed())
+        parser = Parser()
+        self.assertRaises(SystemExit, parser.processArgs,
+                          ['--index', '-k', filename + '.ck', 'PV1', '3',
+                           filename])
+
+class TestCompressed(HL7TestFile):
+
+    def test_compressed(self):
+        filename = self.create_test_file(feed('\n'))
+        expected = self.parse('-atvp', 'PV1', '2,3', filename)
+        self.assertEqual(len(expected), 2)
+        for protocol in ('gzip', 'zip'):
+            compressed = self.compress_test_file(filename, protocol)
+            os.rename(compressed, compressed + '.hl7')
+            self.tempfiles.append(compressed + '.hl7')
+            for mode in ((), ('--mmap',)):
+                argv = mode + ('-atvp', 'PV1', '2,3', compressed + '.hl7')
+                self.assertEqual(self.parse(*argv), expected)
+
+    def test_jobs(self):
+        filename = self.create_test_file(feed('\r', MESSAGES * 5))
+        compressed = self.compress_test_file(filename, 'gzip')
+        parser = Parser()
+        parser.processArgs(['-j', '2', '-o', 'PV1', '2', filename,
+                            compressed])
+        parser.split_size = 100
+        ranges = list(parser.ranges())
+        self.assertEqual(ranges[-1], (compressed, 0, None))
+        self.assertEqual(self.parse_stdout(parser).splitlines(),
+                         ['E^Emergency', 'I^Inpatient'] * 10)
+
+
+class TestQueries(HL7TestFile):
+
+    def output_file(self):
+        """Returns the name for a temporary output file"""
+        filename = self.create_test_file('')
+        os.remove(filename)
+        return filename
+
+    def test_queries(self):
+        filename = self.create_test_file(feed())
+        pv1, evn = self.output_file(), self.output_file()
+        parser = Parser()
+        parser.processArgs(['-t', '-q', 'PV1:2,3:' + pv1, '-q',
+                            'EVN:1:' + evn, '--query', 'MSH:10', filename])
+        self.assertEqual(self.parse_stdout(parser),
+                         '201301011200:1001\n201301021300:1002\n')
+        with open(pv1) as output:
+            self.assertEqual(output.read(),
+                             '201301011200:E^Emergency|ED\n'
+                             '201301021300:I^Inpatient|4W\n')
+        with open(evn) as output:
+            self.assertEqual(output.read(),
+                             '201301011200:A04\n201301021300:A08\n')
+
+    def test_spec(self):
+        filename = self.create_test_file(feed())
+        shared = self.output_file()
+        spec = self.create_test_file('# comment\n\nPV1 3 %s\n'
+                                     'MSH 9 %s\n' % (shared, shared))
+        parser = Parser()
+        parser.processArgs(['-f', '--spec', spec, filename])
+        self.assertEqual(self.parse_stdout(parser), '')
+        with open(shared) as output:
+            self.assertEqual(output.read().splitlines(),
+                             ['READING FILE: %s' % filename,
+                              'ADT^A04', 'ED', 'ADT^A08', '4W'])
+
+
+class TestFilters(HL7TestFile):
+
+    def test_field_ref(self):
+        fields = MESSAGES[0][3].split('|')
+        self.assertEqual(FieldRef('PV1-2').value(fields), 'E^Emergency')
+        self.assertEqual(FieldRef('PV1-2.2').value(fields), 'Emergency')
+        self.assertEqual(FieldRef('PV1-2.3').value(fields), '')
+        self.assertEqual(FieldRef('PV1-44').value(fields), '')
+        fields = MESSAGES[0][0].split('|')
+        self.assertEqual(FieldRef('MSH-9.2').value(fields), 'A04')
+        for bad in ('PV1', 'PV12', 'PV1-x', 'PV1-2.y', 'MSH-0'):
+            self.assertRaises(ValueError, FieldRef, bad)
+        self.assertRaises(ValueError, Filter, 'PV1-2')
+
+    def test_where(self):
+        filename = self.create_test_file(feed())
+        argv = ('-t', 'EVN', '1', filename)
+        self.assertEqual(self.parse('-w', 'MSH-9=ADT^A04', *argv),
+                         ['201301011200:A04'])
+        # decided by a segment following the one displayed
+        self.assertEqual(self.parse('-w', 'PV1-2.1=I', *argv),
+                         ['201301021300:A08'])
+        self.assertEqual(self.parse('-w', 'PV1-2.1!=I', *argv),
+                         ['201301011200:A04'])
+        self.assertEqual(self.parse('-w', 'PV1-2.1=I', '-w',
+                                    'MSH-9.2=A04', *argv), [])
+        self.assertEqual(self.parse('-w', 'OBX-3=ABC', *argv), [])
+        for mode in ('--mmap', '--index'):
+            self.assertEqual(self.parse(mode, '-w', 'PV1-2.1=I', *argv),
+                             ['201301021300:A08'])
+
+
+class TestDelimiters(HL7TestFile):
+
+    def test_declared_delimiters(self):
+        # a standard message followed by one declaring '#' and '$'
+        custom = [segment.replace('|', '#').replace('^', '$')
+                  for segment in MESSAGES[1]]
+        filename = self.create_test_file(
+            feed(messages=(MESSAGES[0], custom)))
+        argv = ('-avp', '-g', 'MSH-9.2', 'PV1', '2,3', filename)
+        expected = ['V100:E:ADT^A04:A04:E^Emergency|ED',
+                    'V200:I:ADT$A08:A08:I$Inpatient|4W']
+        for mode in ((), ('--mmap',), ('--index',)):
+            self.assertEqual(self.parse(*(mode + argv)),
+                             ['      1 ' + line for line in expected])
+        self.assertEqual(self.parse('-w', 'PV1-2.1=I', '-a', 'PV1', '3',
+                                    filename), ['ADT$A08:4W'])
+
+
+class TestCarry(HL7TestFile):
+
+    def test_carry(self):
+        oru = MESSAGES[1][:3] + [
+            'OBR|1||LAB1|PANEL^LAB PANEL', 'OBX|1|NM|WBC||7.1',
+            'OBX|2|NM|HGB||13.2', 'OBR|2||LAB2|FLU^FLU PANEL',
+            'OBX|1|ST|FLUA||NEGATIVE']
+        filename = self.create_test_file(feed(messages=(oru, MESSAGES[0])))
+        self.assertEqual(
+            self.parse('-C', 'OBR-4.1', '--carry', 'PID-3.1', '-v',
+                       'OBX', '3,5', filename),
+            ['V200:PANEL:456:WBC|7.1', 'V200:PANEL:456:HGB|13.2',
+             'V200:FLU:456:FLUA|NEGATIVE'])
+        # carried values don't leak into the next message
+        self.assertEqual(
+            self.parse('-F', 'tsv', '-C', 'OBR-3', 'PV1', '3', filename),
+            ['OBR-3\tPV1-3', '\tED'])
+
+
+class TestFormats(HL7TestFile):
+
+    def test_formats(self):
+        filename = self.create_test_file(feed(messages=(
+            MESSAGES[0][:3] + ['PV1|1|E:x\tE|ED,1'],)))
+        argv = ('-fat', 'PV1', '2,3,99', filename)
+        self.assertEqual(self.parse(*argv),
+                         ['READING FILE: %s' % filename,
+                          'ADT^A04:201301011200:E:x\tE|ED,1'])
+        self.assertEqual(self.parse('--format', 'tsv', *argv),
+                         ['file\tadt\ttime\tPV1-2\tPV1-3\tPV1-99',
+                          '%s\tADT^A04\t201301011200\tE:x E\tED,1\t'
+                          % filename])
+        self.assertEqual(self.parse('-F', 'csv', *argv),
+                         ['file,adt,time,PV1-2,PV1-3,PV1-99',
+                          '%s,ADT^A04,201301011200,E:x\tE,"ED,1",'
+                          % filename])
+        self.assertEqual(self.parse('-F', 'jsonl', '-t', 'MSH', '9', filename),
+                         ['{"time": "201301011200", "MSH-9": "ADT^A04"}'])
+
+    def test_jsonl_encoding(self):
+        # latin-1 isn't valid UTF-8, so is decoded as such
+        filename = self.create_test_file(feed(messages=(
+            MESSAGES[0][:2] + ['PID|1||123^^^MRN||M\xe9NDEZ^JOSE'],
+            MESSAGES[1][:2] + ['PID|1||456^^^MRN||M\xc3\xa9NDEZ^ANA'])))
+        self.assertEqual(self.parse('-F', 'jsonl', 'PID', '5', filename),
+                         ['{"PID-5": "M\\u00e9NDEZ^JOSE"}',
+                          '{"PID-5": "M\\u00e9NDEZ^ANA"}'])
+
+    def test_copy_format(self):
+        output = StringIO()
+        writer = RowWriter(output, 'copy', ['adt', 'PV1-2', 'PV1-99'],
+                           counts=True)
+        writer.write('ignored', ['ADT^A04'], ['E\tx\\y\r', None], 2)
+        self.assertEqual(output.getvalue(),
+                         'ADT^A04\tE\\tx\\\\y\\r\t\\N\t2\n')
+
+    def test_copy_tables(self):
+        filename = self.create_test_file(feed())
+        for argv in (['PV1', '2'], ['-q', 'PV1:2:visits;drop'],
+                     ['-q', 'PV1:2:visits', '-q', 'MSH:9:visits']):
+            parser = Parser()
+            self.assertRaises(SystemExit, parser.processArgs,
+                              ['--copy', 'warehouse'] + argv + [filename])
+        parser = Parser()
+        parser.processArgs(['--copy', 'warehouse', '-q', 'PV1:2:hl7.visits',
+                            filename])
+        self.assertEqual(parser.format, 'copy')
+
+    def test_shared_output(self):
+        filename = self.create_test_file(feed())
+        parser = Parser()
+        self.assertRaises(SystemExit, parser.processArgs,
+                          ['-F', 'csv', '-q', 'MSH:9', '-q', 'PV1:2',
+                           filename])
+
+
+class TestCounts(HL7TestFile):
+
+    def test_count(self):
+        filename = self.create_test_file(
+            feed(messages=MESSAGES * 3 + MESSAGES[:1]))
+        self.assertEqual(self.parse('--count', 'PV1', '2', filename),
+                         ['      4 E^Emergency', '      3 I^Inpatient'])
+        self.assertEqual(self.parse('-c', '-F', 'csv', '-g', 'MSH-7:6',
+                                    'MSH', '9', filename),
+                         ['MSH-7:6,MSH-9,count',
+                          '201301,ADT^A04,4', '201301,ADT^A08,3'])
+        self.assertEqual(self.parse('-g', 'PV1-2.1', '-g', 'MSH-9.2',
+                                    '-F', 'jsonl', 'EVN', '0', filename),
+                         ['{"PV1-2.1": "", "MSH-9.2": "A04", '
+                          '"EVN-0": "EVN", "count": 4}',
+                          '{"PV1-2.1": "", "MSH-9.2": "A08", '
+                          '"EVN-0": "EVN", "count": 3}'])
+        self.assertEqual(self.parse('-f', '-g', 'PV1-2.1', 'PV1', '3',
+                                    filename),
+                         ['      4 %s:E:ED' % filename,
+                          '      3 %s:I:4W' % filename])
+
+    def test_count_jobs(self):
+        filename = self.create_test_file(feed(messages=MESSAGES * 10))
+        compressed = self.compress_test_file(filename, 'gzip')
+        parser = Parser()
+        parser.processArgs(['-j', '3', '-c', '-t', 'MSH', '9',
+                            filename, compressed])
+        parser.split_size = 100
+        self.assertEqual(self.parse_stdout(parser).splitlines(),
+                         ['     20 201301011200:ADT^A04',
+                          '     20 201301021300:ADT^A08'])
+
+
+class TestMemoryLimit(HL7TestFile):
+
+    def test_max_segment(self):
+        obx = 'OBX|1|ED|PDF^Report||' + 'A' * 3000 + '|||N|||F'
+        content = feed(messages=[MESSAGES[0][:1] + [obx],
+                                 [segment.replace('|', '#')
+                                  for segment in MESSAGES[1][:1] + [obx]]])
+        filename = self.create_test_file(content)
+        for flags in ([], ['-m'], ['-i']):
+            self.assertEqual(self.parse(*(flags + [
+                '--max-segment', '30', 'OBX', '2,5,8,11', filename])),
+                ['ED|%s|N|F' % ('A' * 30)] * 2)
+
+    def test_spilling_counter(self):
+        counts = SpillingCounter(limit=0)
+        for key in ('b', 'a', 'c', 'a', 'b', 'a'):
+            counts.add((0, None, (), (key,)))
+        self.assertEqual(len(counts.runs), 6)
+        self.assertEqual(list(counts.sorted_items()),
+                         [((0, None, (), ('a',)), 3),
+                          ((0, None, (), ('b',)), 2),
+                          ((0, None, (), ('c',)), 1)])
+        counts.close()
+
+    def test_spilled_missing_sequence(self):
+        filename = self.create_test_file(feed(messages=MESSAGES * 3))
+        argv = ['-c', 'PV1', '2,40', filename]
+        expected = self.parse(*argv)
+        self.assertEqual(expected, ['      3 E^Emergency', '      3 I^Inpatient'])
+        self.assertEqual(self.parse('--memory-limit', '1', *argv), expected)
+
+    def test_spilled_jobs(self):
+        filename = self.create_test_file(feed(messages=MESSAGES * 10))
+        argv = ['-c', '-t', 'PV1', '2,40', filename]
+        expected = self.parse(*argv)
+        parser = Parser()
+        parser.processArgs(['-j', '2'] + argv)
+        parser.split_size = 100
+        parser.memory_limit = 300
+        self.assertEqual(self.parse_stdout(parser).splitlines(), expected)
+
+    def test_spilled_counts(self):
+        filename = self.create_test_file(feed(messages=MESSAGES * 3))
+        argv = ['-c', '-t', '-f', 'PV1', '3', filename]
+        expected = self.parse(*argv)
+        parser = Parser()
+        parser.processArgs(['--memory-limit', '1'] + argv)
+        parser.memory_limit = 300
+        self.assertEqual(self.parse_stdout(parser).splitlines(), expected)
+
+
+class TestShards(HL7TestFile):
+
+    def setUp(self):
+        super(TestShards, self).setUp()
+        self.directory = mkdtemp(prefix='unittest')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def read_shard(self, name):
+        """Returns the lines of the named shard file"""
+        filename = os.path.join(self.directory, name)
+        if name.endswith('.gz'):
+            return expand_file(filename, zip_protocol='gzip').read(
+                ).splitlines()
+        with open(filename) as shard:
+            return shard.read().splitlines()
+
+    def test_shard_name(self):
+        self.assertEqual(shard_name('ADT^A04'), 'ADT^A04')
+        self.assertEqual(shard_name('../etc/passwd'), '_etc_passwd')
+        self.assertEqual(shard_name(''), '_')
+
+    def test_shard(self):
+        filename = self.create_test_file(feed(messages=MESSAGES * 3))
+        template = os.path.join(self.directory,
+                                '{MSH-7:8}', '{MSH-9.2}.tsv.gz')
+        self.assertEqual(self.parse('-F', 'tsv', '-v', '--shard', template,
+                                    'PV1', '3', filename), [])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['20130101', '20130102'])
+        self.assertEqual(self.read_shard('20130101/A04.tsv.gz'),
+                         ['visit_id\tPV1-3'] + ['V100\tED'] * 3)
+        self.assertEqual(self.read_shard('20130102/A08.tsv.gz'),
+                         ['visit_id\tPV1-3'] + ['V200\t4W'] * 3)
+
+    def test_reopened(self):
+        # with a single file open, every row reopens its shard
+        filename = self.create_test_file(feed(messages=MESSAGES * 3))
+        for name in ('{MSH-9.2}.csv', '{MSH-9.2}.csv.gz'):
+            template = os.path.join(self.directory, name)
+            self.parse('-F', 'csv', '--max-open-shards', '1', '-q',
+                       'PV1:2:' + template, filename)
+            self.assertEqual(self.read_shard(name.replace('{MSH-9.2}',
+                                                          'A04')),
+                             ['PV1-2'] + ['E^Emergency'] * 3)
+
+    def test_many_shards(self):
+        messages = [[MESSAGES[0][0].replace('|1001|', '|%d|' % (i % 5))] +
+                    MESSAGES[0][1:] for i in range(15)]
+        filename = self.create_test_file(feed(messages=messages))
+        template = os.path.join(self.directory, '{MSH-10}.tsv')
+        parser = Parser()
+        parser.processArgs(['-F', 'tsv', '--max-open-shards', '2', '-q',
+                            'PV1:3:' + template, filename])
+        writers = parser.open_outputs()
+        parser.process(writers, None, filename)
+        # only what is open is kept, however many shards are written
+        self.assertEqual(len(writers[0].output.open_files), 2)
+        self.assertEqual(len(writers[0].paths), 2)
+        writers[0].output.close()
+        for i in range(5):
+            self.assertEqual(self.read_shard('%d.tsv' % i),
+                             ['PV1-3'] + ['ED'] * 3)
+
+    def test_count_shards(self):
+        filename = self.create_test_file(
+            feed(messages=MESSAGES * 3 + MESSAGES[:1]))
+        template = os.path.join(self.directory, 'counts-{MSH-9.2}')
+        self.parse('-c', '-q', 'PV1:3:' + template, '-q', 'MSH:9',
+                   filename)
+        self.assertEqual(self.read_shard('counts-A04'), ['      4 ED'])
+        self.assertEqual(self.read_shard('counts-A08'), ['      3 4W'])
+
+    def test_zip(self):
+        filename = self.create_test_file(feed())
+        self.assertRaises(SystemExit, Parser().processArgs,
+                          ['--shard', '{MSH-9}.zip', 'PV1', '3', filename])
+
+
+class TestCheckpoint(HL7TestFile):
+
+    def test_last_message_boundary(self):
+        content = feed('\\r')
+        second = content.index('MSH', 1)
+        filename = self.create_test_file(content)
+        with open(filename, 'rb') as fh:
+            self.assertEqual(last_message_boundary(fh, 0, len(content)),
+                             second)
+            self.assertEqual(last_message_boundary(fh, 1, second), None)
+            self.assertEqual(last_message_boundary(fh, 0, second), 0)
+
+    def test_appended_range(self):
+        content = feed()
+        filename = self.create_test_file(content)
+        inode = os.stat(filename).st_ino
+        second = content.index('MSH', 1)
+        self.assertEqual(appended_range(filename, (0, None), 3600),
+                         (0, second, inode))
+        self.assertEqual(appended_range(filename, (second, inode), 3600),
+                         None)
+        self.assertEqual(appended_range(filename, (second, inode), 0),
+                         (second, len(content), inode))
+        self.assertEqual(appended_range(filename, (len(content), inode), 0),
+                         None)
+        # a replaced file starts over
+        self.assertEqual(appended_range(filename, (second, inode + 1), 0),
+                         (0, len(content), inode))
+
+    def run_checkpointed(self, checkpoint, filename, interval):
+        parser = Parser()
+        parser.processArgs(['-k', checkpoint, '--interval', str(interval),
+                            'PV1', '3', filename])
+        return self.parse_stdout(parser).splitlines()
+
+    def test_checkpoint(self):
+        filename = self.create_test_file(feed())
+        checkpoint = self.create_test_file('')
+        os.remove(checkpoint)
+        # the final message may still be being written
+        self.assertEqual(
+            self.run_checkpointed(checkpoint, filename, 3600), ['ED'])
+        self.assertEqual(load_checkpoint(checkpoint)[filename][0],
+                         feed().index('MSH', 1))
+        self.assertEqual(
+            self.run_checkpointed(checkpoint, filename, 3600), [])
+        # once quiet, the final message is complete
+        self.assertEqual(
+            self.run_checkpointed(checkpoint, filename, 0), ['4W'])
+        with open(filename, 'ab') as fh:
+            fh.write(feed(messages=MESSAGES[:1]) + 'MSH|^~\\&|partial')
+        self.assertEqual(
+            self.run_checkpointed(checkpoint, filename, 0), ['ED'])
+        # truncation starts over
+        with open(filename, 'wb') as fh:
+            fh.write(feed(messages=MESSAGES[1:]))
+        self.assertEqual(
+            self.run_checkpointed(checkpoint, filename, 0), ['4W'])
+
+    def test_checkpoint_delimiters(self):
+        # a feed declaring '#' as its field delimiter
+        content = feed(messages=[[segment.replace('|', '#')
+                                  for segment in message]
+                                 for message in MESSAGES])
+        filename = self.create_test_file(content)
+        checkpoint = self.create_test_file('')
+        os.remove(checkpoint)
+        with open(filename, 'rb') as fh:
+            self.assertEqual(last_message_boundary(fh, 0, len(content)),
+                             content.index('MSH', 1))
+        self.assertEqual(
+            self.run_checkpointed(checkpoint, filename, 3600), ['ED'])
+        self.assertEqual(load_checkpoint(checkpoint)[filename][0],
+                         content.index('MSH', 1))
+
+    def test_checkpoint_compressed(self):
+        filename = self.create_test_file(feed())
+        compressed = self.compress_test_file(filename, 'gzip')
+        checkpoint = self.create_test_file('')
+        os.remove(checkpoint)
+        self.assertEqual(
+            self.run_checkpointed(checkpoint, compressed, 3600),
+            ['ED', '4W'])
+        self.assertEqual(
+            self.run_checkpointed(checkpoint, compressed, 3600), [])
+
+
+class TestManifest(HL7TestFile):
+
+    def create_manifest(self):
+        """Returns the name for a manifest yet to be created"""
+        manifest = self.create_test_file('')
+        os.remove(manifest)
+        self.addCleanup(shutil.rmtree, manifest + '.matches', True)
+        return manifest
+
+    def run_manifested(self, manifest, *argv):
+        parser = Parser()
+        parser.processArgs(['--manifest', manifest] + list(argv))
+        return parser, self.parse_stdout(parser).splitlines()
+
+    def doctor(self, parser, manifest, filename):
+        """Replace the recorded matches for filename, so a replay is
+        told apart from a scan"""
+        entries = load_manifest(manifest, parser.manifest_key())
+        save_matches(matches_filename(manifest, entries[filename]['hash']),
+                     [(0, [], ['cached'])])
+
+    def test_manifest(self):
+        filename = self.create_test_file(feed())
+        manifest = self.create_manifest()
+        parser, lines = self.run_manifested(manifest, 'PV1', '3', filename)
+        self.assertEqual(lines, ['ED', '4W'])
+        self.doctor(parser, manifest, filename)
+        self.assertEqual(
+            self.run_manifested(manifest, 'PV1', '3', filename)[1],
+            ['cached'])
+        # a new mtime alone is settled by the hash
+        os.utime(filename, (0, 0))
+        self.assertEqual(
+            self.run_manifested(manifest, 'PV1', '3', filename)[1],
+            ['cached'])
+        self.assertEqual(load_manifest(manifest, parser.manifest_key())
+                         [filename]['mtime'], 0)
+        with open(filename, 'ab') as fh:
+            fh.write(feed(messages=MESSAGES[:1]))
+        self.assertEqual(
+            self.run_manifested(manifest, 'PV1', '3', filename)[1],
+            ['ED', '4W', 'ED'])
+
+    def test_changed_query(self):
+        filename = self.create_test_file(feed())
+        manifest = self.create_manifest()
+        parser, lines = self.run_manifested(manifest, 'PV1', '3', filename)
+        self.doctor(parser, manifest, filename)
+        self.assertEqual(
+            self.run_manifested(manifest, '-a', 'PV1', '3', filename)[1],
+            ['ADT^A04:ED', 'ADT^A08:4W'])
+        self.assertEqual(
+            self.run_manifested(manifest, 'PV1', '2', filename)[1],
+            ['E^Emergency', 'I^Inpatient'])
+        self.assertEqual(
+            self.run_manifested(manifest, '--max-segment', '8',
+                                'PV1', '2', filename)[1],
+            ['E^Emerge', 'I^Inpati'])
+
+    def test_stale_matches(self):
+        filename = self.create_test_file(feed())
+        manifest = self.create_manifest()
+        parser, lines = self.run_manifested(manifest, 'PV1', '3', filename)
+        digest = load_manifest(manifest, parser.manifest_key())[
+            filename]['hash']
+        with open(filename, 'ab') as fh:
+            fh.write(feed(messages=MESSAGES[:1]))
+        self.run_manifested(manifest, 'PV1', '3', filename)
+        self.assertFalse(os.path.exists(matches_filename(manifest, digest)))
+        self.assertEqual(len(os.listdir(manifest + '.matches')), 1)
+
+    def test_parallel_counts(self):
+        unchanged = self.create_test_file(feed())
+        changed = self.create_test_file(feed(messages=MESSAGES[1:]))
+        manifest = self.create_manifest()
+        parser, lines = self.run_manifested(manifest, 'PV1', '3',
+                                            unchanged, changed)
+        self.doctor(parser, manifest, unchanged)
+        with open(changed, 'ab') as fh:
+            fh.write(feed(messages=MESSAGES[1:]))
+        parser, lines = self.run_manifested(
+            manifest, '-c', '-j', '2', 'PV1', '3', unchanged, changed)
+        self.assertEqual(lines, ['      2 4W', '      1 cached'])
+
+
+class TestTimeWindow(HL7TestFile):
+
+    def test_window(self):
+        filename = self.create_test_file(feed())
+        argv = ('-t', 'PV1', '3', filename)
+        self.assertEqual(self.parse('--since', '20130102', *argv),
+                         ['201301021300:4W'])
+        self.assertEqual(self.parse('--until', '201301011200', *argv),
+                         ['201301011200:ED'])
+        self.assertEqual(self.parse('--since', '2013010113', '--until',
+                                    '2013010213', *argv),
+                         ['201301021300:4W'])
+        self.assertRaises(SystemExit, Parser().processArgs,
+                          ['--since', '2013-01-01'] + list(argv))
+
+    def test_time_range(self):
+        filename = self.create_test_file(feed())
+        compressed = self.compress_test_file(filename, 'gzip')
+        empty = self.create_test_file('')
+        expected = ('201301011200', '201301021300')
+        self.assertEqual(load_time_range(filename), expected)
+        self.assertTrue(os.path.exists(times_filename(filename)))
+        self.assertEqual(load_time_range(filename), expected)
+        self.assertEqual(load_time_range(compressed), expected)
+        self.assertEqual(load_time_range(empty), (None, None))
+        self.assertEqual(load_time_range(empty), (None, None))
+
+    def test_skip_files(self):
+        filename = self.create_test_file(feed())
+        load_time_range(filename)
+        # a file claiming to be out of the window is never read
+        with open(times_filename(filename)) as times:
+            lines = times.readlines()
+        with open(times_filename(filename), 'w') as times:
+            times.writelines(lines[:2] + ['2012\n', '2012\n'])
+        self.assertEqual(self.parse('--since', '2013', 'PV1', '3',
+                                    filename), [])
+        self.assertEqual(self.parse('--until', '2013', 'PV1', '3',
+                                    filename), ['ED', '4W'])
+
+    def test_glob_sidecars(self):
+        directory = mkdtemp(prefix='unittest')
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'a.hl7'), 'wb') as fh:
+            fh.write(feed())
+        for run in range(3):
+            self.assertEqual(self.parse('--since', '2013', 'PV1', '3',
+                                        os.path.join(directory, '*')),
+                             ['ED', '4W'])
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['a.hl7', 'a.hl7.times'])
+
+    def test_unwritable_sidecar(self):
+        filename = self.create_test_file(feed())
+        # as if the archive directory were read only
+        unwritable = lambda filename: os.path.join(
+            filename + '.missing', 'sidecar')
+        original = HL7_segment_parser.times_filename
+        HL7_segment_parser.times_filename = unwritable
+        try:
+            self.assertRaises(IOError, load_time_range, filename)
+            self.assertEqual(self.parse('--since', '20130102', 'PV1', '3',
+                                        filename), ['4W'])
+        finally:
+            HL7_segment_parser.times_filename = original
+
+
+class TestSortByTime(HL7TestFile):
+
+    def timed(self, *times):
+        """Returns a feed of the first message at each of times"""
+        return feed(messages=[
+            [MESSAGES[0][0].replace('201301011200', when)] +
+            MESSAGES[0][1:3] + ['PV1|1|E|%s' % when] for when in times])
+
+    def test_merge(self):
+        first = self.create_test_file(self.timed('201301011200',
+                                                 '201301011300'))
+        second = self.create_test_file(self.timed('201301011100',
+                                                  '201301011200',
+                                                  '201301011400'))
+        third = self.compress_test_file(
+            self.create_test_file(self.timed('201301011230')), 'gzip')
+        self.assertEqual(
+            self.parse('--sort-by-time', 'PV1', '3', first, second, third),
+            ['201301011100', '201301011200', '201301011200',
+             '201301011230', '201301011300', '201301011400'])
+        self.assertEqual(
+            self.parse('--sort-by-time', '-f', 'PV1', '3', first, second)[:3],
+            ['%s:201301011100' % second, '%s:201301011200' % first,
+             '%s:201301011200' % second])
+
+    def test_plan_once(self):
+        filename = self.create_test_file(self.timed(
+            '201301011100', '201301011200', '201301011300'))
+        parser = Parser()
+        parser.processArgs(['--sort-by-time', '-v', 'PV1', '3', filename])
+        plans = []
+        scan_plan = parser.scan_plan
+        parser.scan_plan = lambda: plans.append(scan_plan()) or plans[-1]
+        self.assertEqual(self.parse_stdout(parser).splitlines(),
+                         ['V100:201301011100', 'V100:201301011200',
+                          'V100:201301011300'])
+        self.assertEqual(len(plans), 1)
+
+    def test_incompatible(self):
+        filename = self.create_test_file(feed())
+        parser = Parser()
+        self.assertRaises(SystemExit, parser.processArgs,
+                          ['--sort-by-time', '-j', '2', 'PV1', '3', filename])
+
+
+class TestStats(HL7TestFile):
+
+    def parse_stats(self, *argv):
+        """Returns the --stats report, as a dictionary"""
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.parse('--stats', *argv)
+            report = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        return dict(line.split(':', 1) for line in report.splitlines())
+
+    def test_stats(self):
+        content = feed(messages=MESSAGES * 3)
+        filename = self.create_test_file(content)
+        for mode in ((), ('--mmap',), ('-j', '2')):
+            report = self.parse_stats(*(mode + ('PV1', '2', filename)))
+            self.assertEqual(int(report['bytes read'].split()[0]),
+                             len(content))
+            self.assertEqual(int(report['messages']), 6)
+            self.assertEqual(int(report['segments matched']), 6)
+            for phase in ('read', 'scan', 'write'):
+                self.assertTrue(report[phase + ' time'].strip())
+        # only the MSH and PV1 segments reach the scan
+        report = self.parse_stats('PV1', '2', filename)
+        self.assertEqual(int(report['segments scanned']), 12)
+
+    def test_profile(self):
+        filename = self.create_test_file(feed())
+        profile = self.create_test_file('')
+        argv, sys.argv = sys.argv, ['HL7_segment_parser', '--profile',
+                                    profile, 'PV1', '2', filename]
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            main()
+            self.assertEqual(sys.stdout.getvalue(),
+                             'E^Emergency\nI^Inpatient\n')
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+        self.assertTrue(pstats.Stats(profile).total_calls > 0)
+
+
+class TestDedup(HL7TestFile):
+
+    def test_seen_set(self):
+        seen = SeenSet(capacity=100)
+        self.assertTrue(seen.add('1001'))
+        self.assertFalse(seen.add('1001'))
+        self.assertTrue(seen.add(''))
+        self.assertTrue(seen.add(''))
+        self.assertTrue(all(seen.add(str(i)) for i in range(100)))
+        # past the exact limit the Bloom filter answers alone
+        seen = SeenSet(capacity=1000, exact_limit=10)
+        self.assertEqual(sum(seen.add(str(i)) for i in range(1000)), 1000)
+        self.assertEqual(seen.exact, None)
+        self.assertFalse(seen.add('999'))
+
+    def test_past_capacity(self):
+        # the filter grows rather than dropping unique ids
+        seen = SeenSet(capacity=1000, exact_limit=10)
+        self.assertTrue(sum(seen.add(str(i)) for i in range(20000)) > 19990)
+        self.assertEqual(len(seen.slices), 5)
+        self.assertFalse(any(seen.add(str(i)) for i in range(0, 20000, 7)))
+
+    def test_dedup(self):
+        first = self.create_test_file(feed())
+        # a replay of the second message, then a new one
+        replayed = MESSAGES[1:] + (
+            [MESSAGES[0][0].replace('|1001|', '|1003|')] + MESSAGES[0][1:],)
+        second = self.create_test_file(feed(messages=replayed))
+        self.assertEqual(self.parse('PV1', '3', first, second),
+                         ['ED', '4W', '4W', 'ED'])
+        self.assertEqual(self.parse('--dedup', 'PV1', '3', first, second),
+                         ['ED', '4W', 'ED'])
+        self.assertEqual(self.parse('--dedup', '-c', 'PV1', '3', first,
+                                    second), ['      1 4W', '      2 ED'])
+
+    def test_parallel_dedup(self):
+        filenames = [self.create_test_file(feed(terminator, MESSAGES * 5))
+                     for terminator in ('\r', '\n')]
+        argv = ['--dedup', '-a', 'PV1', '3'] + filenames
+        for jobs in (['--ordered'], ['--count']):
+            parallel = Parser()
+            parallel.processArgs(['--jobs', '2'] + jobs + argv)
+            parallel.split_size = 100
+            self.assertTrue(len(list(parallel.ranges())) > len(filenames))
+            self.assertEqual(len(self.parse_stdout(parallel).splitlines()), 2)
+
+
+class TestParallel(HL7TestFile):
+
+    def test_message_boundary(self):
+        for terminator in ('\r', '\n', '\\r'):
+            content = feed(terminator)
+            second = content.index('MSH', 1)
+            for offset in (1, 10, second):
+                self.assertEqual(
+                    message_boundary(StringIO(content), offset,
+                                     chunk_size=4), second)
+            self.assertEqual(message_boundary(StringIO(content), 0), 0)
+            self.assertEqual(
+                message_boundary(StringIO(content), second + 1), None)
+
+    def test_ranges_delimiters(self):
+        messages = [[segment.replace('|', '#') for segment in message]
+                    for message in MESSAGES * 5]
+        content = feed(messages=messages)
+        filename = self.create_test_file(content)
+        self.assertEqual(message_boundary(StringIO(content), 1, 4),
+                         content.index('MSH', 1))
+        parser = Parser()
+        parser.processArgs(['--jobs', '2', 'PV1', '3', filename])
+        parser.split_size = 100
+        ranges = list(parser.ranges())
+        self.assertTrue(len(ranges) > 1)
+        for name, start, end in ranges:
+            self.assertEqual(content[start:start + 4], 'MSH#')
+
+    def test_ordered_jobs(self):
+        filenames = [self.create_test_file(feed(terminator, MESSAGES * 5))
+                     for terminator in ('\r', '\n', '\\r')]
+        argv = ['-atvpf', 'PV1', '2,3'] + filenames
+        serial = Parser()
+        serial.processArgs(argv)
+        expected = self.parse_stdout(serial)
+        self.assertEqual(len(expected.splitlines()), 33)
+        for mode in ([], ['--mmap'], ['--index']):
+            parallel = Parser()
+            parallel.processArgs(['--jobs', '3', '--ordered'] + mode + argv)
+            parallel.split_size = 100
+            self.assertTrue(len(list(parallel.ranges())) > len(filenames))
+            self.assertEqual(self.parse_stdout(parallel), expected)
+
+    def test_unordered_files(self):
+        filenames = [self.create_test_file(feed(messages=MESSAGES * 20))
+                     for copy in range(2)]
+        parser = Parser()
+        parser.processArgs(['--jobs', '3', '-f', 'PV1', '3'] + filenames)
+        parser.split_size = 100
+        lines = self.parse_stdout(parser).splitlines()
+        # pieces complete in any order, so each match names its file
+        self.assertEqual(sorted(lines), sorted(
+            ['%s:%s' % (filename, value) for filename in filenames
+             for value in ('ED', '4W') * 20]))
+        self.assertEqual(
+            self.parse('--jobs', '3', '--ordered', '-f', 'PV1', '3',
+                       filenames[0])[:2],
+            ['READING FILE: %s' % filenames[0], 'ED'])
+
+    def test_pool_worker(self):
+        filename = self.create_test_file(feed())
+        parser = Parser()
+        parser.processArgs(['--jobs', '2', '--dedup', 'PV1', '3', filename])
+        parser.seen = SeenSet(parser.dedup_capacity)
+        worker = parser.pool_worker()
+        self.assertEqual((worker.filelist, worker.patterns, worker.seen),
+                         ([], [], None))
+        self.assertEqual(parser.filelist, [filename])
+        self.assertEqual(worker.queries, parser.queries)
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -4,7 +4,7 @@ import os
 import unittest
 from tempfile import NamedTemporaryFile
 
-from pheme.util.compression import expand_file, zip_file
+from pheme.util.compression import expand_file, zip_file, zip_protocol
 
 
 class TestFile(unittest.TestCase):
@@ -120,3 +120,8 @@ class ZipTests(TestFile):
                                output='file')
         with open(expanded, 'rb') as result:
             self.assertEqual(result.read(), self.test_text)
+
+    def test_zip_protocol(self):
+        for compression in (None, 'gzip', 'zip'):
+            filename = self.create_test_file(compression=compression)
+            self.assertEqual(zip_protocol(filename), compression)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+""" Unit tests for the hl7 module.
+
+"""
+import unittest
+
+from pheme.util.hl7 import Message, Segment, iter_messages
+from pheme.util.HL7_segment_parser import delimiters, STANDARD_DELIMITERS
+from pheme.util.tests.test_HL7_segment_parser import HL7TestFile
+from pheme.util.tests.test_HL7_segment_parser import MESSAGES, feed
+
+
+class TestSegment(unittest.TestCase):
+
+    def test_lazy_fields(self):
+        segment = Segment(MESSAGES[0][3])
+        self.assertEqual(segment.type, 'PV1')
+        self.assertEqual(segment._fields, None)
+        self.assertEqual(segment.field(2), 'E^Emergency')
+        self.assertEqual(segment.field(3), 'ED')
+        self.assertEqual(segment.field(99), '')
+        self.assertEqual(segment.component(2, 2), 'Emergency')
+        self.assertEqual(segment.component(2, 3), '')
+        self.assertEqual(segment.component(3, 1), 'ED')
+
+    def test_msh_numbering(self):
+        segment = Segment(MESSAGES[0][0])
+        self.assertEqual(segment.field(1), '|')
+        self.assertEqual(segment.field(2), '^~\\&')
+        self.assertEqual(segment.field(7), '201301011200')
+        self.assertEqual(segment.component(9, 2), 'A04')
+
+    def test_delimiters(self):
+        self.assertTrue(delimiters(MESSAGES[0][0]) is STANDARD_DELIMITERS)
+        found = delimiters('MSH#$*\\@#SEND')
+        self.assertEqual(found, ('#', '$', '*', '\\', '@'))
+        segment = Segment('MSH#$*\\@#SEND#FAC#RECV#FAC#201301011200##ADT$A04',
+                          found)
+        self.assertEqual(segment.field(3), 'SEND')
+        self.assertEqual(segment.component(9, 2), 'A04')
+
+
+class TestMessages(HL7TestFile):
+
+    def test_iter_messages(self):
+        filename = self.create_test_file('EVN|orphan\r' + feed('\n'))
+        messages = list(iter_messages(filename))
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(isinstance(messages[0], Message))
+        self.assertEqual(messages[0].filename, filename)
+        self.assertEqual(messages[1].header.field(10), '1002')
+        self.assertEqual(messages[1].segment('PID').field(18), 'V200')
+        self.assertEqual(messages[0].segment('OBX'), None)
+        self.assertEqual(len(messages[0].segments_of('EVN')), 1)
+        self.assertEqual(str(messages[0]), feed(messages=MESSAGES[:1]))
+
+    def test_slots(self):
+        message = Message(MESSAGES[0])
+        self.assertFalse(hasattr(message, '__dict__'))
+        self.assertFalse(hasattr(message.header, '__dict__'))
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+""" Unit tests for the hl7_benchmark module.
+
+"""
+from cStringIO import StringIO
+from itertools import islice
+import unittest
+
+from pheme.util.hl7_benchmark import measure, synthetic_messages
+from pheme.util.hl7_benchmark import write_corpus
+from pheme.util.tests.test_HL7_segment_parser import HL7TestFile
+
+
+class TestCorpus(HL7TestFile):
+
+    def test_deterministic(self):
+        first = list(islice(synthetic_messages(seed=7), 50))
+        self.assertEqual(first, list(islice(synthetic_messages(seed=7), 50)))
+        self.assertNotEqual(first,
+                            list(islice(synthetic_messages(seed=8), 50)))
+        types = set(message[0].split('|')[8] for message in first)
+        self.assertTrue('ORU^R01' in types)
+        self.assertTrue('ADT^A08' in types)
+
+    def test_write_corpus(self):
+        for terminator in ('\r', '\n', '\\r'):
+            corpus = StringIO()
+            count = write_corpus(corpus, 20000, terminator)
+            self.assertTrue(len(corpus.getvalue()) >= 20000)
+            filename = self.create_test_file(corpus.getvalue())
+            lines = self.parse('-c', 'MSH', '12', filename)
+            self.assertEqual(lines, ['%7d 2.5.1' % count])
+            visits = self.parse('-v', 'PV1', '2', filename)
+            self.assertEqual(len(visits), count)
+            self.assertTrue(all(line.startswith('V') for line in visits))
+
+    def test_measure(self):
+        corpus = StringIO()
+        write_corpus(corpus, 10000)
+        filename = self.create_test_file(corpus.getvalue())
+        elapsed, peak = measure(['PV1', '2', filename])
+        self.assertTrue(elapsed >= 0)
+        self.assertTrue(peak > 0)
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+""" Unit tests for the hl7_store module.
+
+"""
+import shutil
+import tempfile
+import unittest
+
+from pheme.util.hl7_store import MessageStore
+from pheme.util.tests.test_HL7_segment_parser import HL7TestFile
+from pheme.util.tests.test_HL7_segment_parser import MESSAGES, feed
+
+
+def visit_message(visit, when):
+    """Returns the first test message, for visit at time when"""
+    return ([MESSAGES[0][0].replace('201301011200', when),
+             MESSAGES[0][1],
+             MESSAGES[0][2].replace('V100', visit)] + MESSAGES[0][3:])
+
+
+class TestMessageStore(HL7TestFile):
+
+    def setUp(self):
+        super(TestMessageStore, self).setUp()
+        self.directory = tempfile.mkdtemp(prefix='unittest')
+
+    def tearDown(self):
+        super(TestMessageStore, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def times(self, store, visit, **window):
+        return [message.header.field(7) for message in
+                store.lookup(visit, **window)]
+
+    def test_lookup(self):
+        filename = self.create_test_file(feed('\n', messages=(
+            visit_message('V10', '201301030000'),
+            visit_message('V1', '201301020000'),
+            visit_message('V1', '201301010000'),
+            ['MSH|^~\\&|SEND|FAC|RECV|FAC|201301011200||ADT^A04|9|P|2.3',
+             'PV1|1|E|ED'])))
+        store = MessageStore(self.directory)
+        self.assertEqual(store.add_file(filename), 3)
+        self.assertEqual(self.times(store, 'V1'),
+                         ['201301010000', '201301020000'])
+        self.assertEqual(self.times(store, 'V10'), ['201301030000'])
+        self.assertEqual(self.times(store, 'V2'), [])
+        self.assertEqual(self.times(store, 'V1', since='20130102'),
+                         ['201301020000'])
+        self.assertEqual(self.times(store, 'V1', until='20130101'),
+                         ['201301010000'])
+        message = next(store.lookup('V10'))
+        self.assertEqual(message.segment('PID').field(18), 'V10')
+        self.assertEqual(str(message),
+                         feed(messages=[visit_message('V10',
+                                                      '201301030000')]))
+
+    def test_incremental(self):
+        filename = self.create_test_file(
+            feed(messages=[visit_message('V1', '201301010000')]) +
+            'MSH|^~\\&|partial')
+        store = MessageStore(self.directory, max_runs=2, interval=0)
+        self.assertEqual(store.add_file(filename), 1)
+        self.assertEqual(store.add_file(filename), 0)
+        with open(filename, 'ab') as fh:
+            fh.write('|RECV\r' + feed(messages=[
+                visit_message('V1', '201301020000')]))
+        # the completed partial message has no visit id
+        self.assertEqual(store.add_file(filename), 1)
+        self.assertEqual(len(store.runs()), 2)
+        other = self.create_test_file(
+            feed(messages=[visit_message('V1', '201301030000')]))
+        store.add_file(other)
+        # merged once more than two runs were written
+        self.assertEqual(len(store.runs()), 1)
+        self.assertEqual(self.times(store, 'V1'),
+                         ['201301010000', '201301020000', '201301030000'])
+        compressed = self.compress_test_file(other, 'gzip')
+        self.assertEqual(store.add_file(compressed), 1)
+        self.assertEqual(store.add_file(compressed), 0)
+
+    def test_segment_writes(self):
+        # written a segment at a time, the message is only taken once
+        # the file has gone quiet
+        message = visit_message('V1', '201301010000')
+        filename = self.create_test_file(feed(messages=[message[:3]]))
+        store = MessageStore(self.directory, interval=60)
+        self.assertEqual(store.add_file(filename), 0)
+        with open(filename, 'ab') as fh:
+            fh.write(feed(messages=[message[3:]]))
+        self.assertEqual(store.add_file(filename), 0)
+        store.interval = 0
+        self.assertEqual(store.add_file(filename), 1)
+        self.assertEqual(str(next(store.lookup('V1'))),
+                         feed(messages=[message]))
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
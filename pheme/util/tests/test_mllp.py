@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+""" Unit tests for the mllp module.
+
+"""
+from cStringIO import StringIO
+import socket
+import sys
+import threading
+import unittest
+
+from pheme.util.HL7_segment_parser import Parser
+from pheme.util.mllp import END_BLOCK, START_BLOCK, MLLPServer
+from pheme.util.mllp import ack, iter_frames
+from pheme.util.tests.test_HL7_segment_parser import MESSAGES, feed
+
+
+def frame(message):
+    """Returns message wrapped in the MLLP start and end blocks"""
+    return START_BLOCK + message + END_BLOCK
+
+
+class TestFrames(unittest.TestCase):
+
+    def test_iter_frames(self):
+        stream = StringIO('noise' + frame(feed(messages=MESSAGES[:1])) +
+                          '\r\n' + frame(feed(messages=MESSAGES[1:])) +
+                          START_BLOCK + 'incomplete')
+        for chunk_size in (1, 3, 4096):
+            stream.seek(0)
+            self.assertEqual(list(iter_frames(stream.read, chunk_size)),
+                             [feed(messages=MESSAGES[:1]),
+                              feed(messages=MESSAGES[1:])])
+
+    def test_max_message(self):
+        first, second = (feed(messages=MESSAGES[:1]),
+                         feed(messages=MESSAGES[1:]))
+        stream = StringIO(frame(first) + frame(second) + frame('MSH|short'))
+        for chunk_size in (1, 3, 4096):
+            stream.seek(0)
+            self.assertEqual(list(iter_frames(stream.read, chunk_size, 40)),
+                             [first[:40], second[:40], 'MSH|short'])
+
+    def test_ack(self):
+        found = ack(feed(messages=MESSAGES[:1])).split('\r')
+        self.assertEqual(found[0].split('|')[:6],
+                         ['MSH', '^~\\&', 'RECV', 'FAC', 'SEND', 'FAC'])
+        self.assertEqual(found[0].split('|')[8:],
+                         ['ACK^A04', 'ACK1001', 'P', '2.3'])
+        self.assertEqual(found[1], 'MSA|AA|1001')
+        self.assertEqual(ack('garbage').split('\r')[1], 'MSA|AR|')
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+        parser = Parser()
+        parser.processArgs(['-F', 'tsv', '-fa', 'PV1', '3'],
+                           require_files=False)
+        self.server = MLLPServer(('localhost', 0), parser)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def send(self, messages, acks):
+        """Send each message framed on a new connection, appending the
+        acknowledgements received to acks"""
+        connection = socket.create_connection(self.server.server_address)
+        try:
+            for message in messages:
+                connection.sendall(frame(message))
+                acks.extend(iter_frames(connection.recv).next()
+                            .split('\r')[1:2])
+        finally:
+            connection.close()
+
+    def test_concurrent_senders(self):
+        acks = []
+        senders = [threading.Thread(target=self.send, args=(
+            [feed(messages=(message,)) for message in MESSAGES] * 5, acks))
+            for i in range(4)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+        self.assertEqual(sorted(acks), ['MSA|AA|1001'] * 20 +
+                         ['MSA|AA|1002'] * 20)
+        lines = sys.stdout.getvalue().splitlines()
+        self.assertEqual(lines[0], 'file\tadt\tPV1-3')
+        rows = [line.split('\t') for line in lines[1:]]
+        self.assertEqual(len(rows), 40)
+        self.assertEqual(sorted(set(tuple(row[1:]) for row in rows)),
+                         [('ADT^A04', 'ED'), ('ADT^A08', '4W')])
+        self.assertTrue(rows[0][0].startswith('127.0.0.1:'))
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+""" Unit tests for the pg_copy module.
+
+The database connection is replaced with a stub, recording the COPY
+statements sent and the commits and rollbacks made.  Where psycopg2
+(or sqlalchemy, imported by pg_access) isn't installed, a stub module
+stands in for it while pg_copy is imported, as only the connection
+is used.
+
+"""
+import sys
+import types
+import unittest
+
+from pheme.util import HL7_segment_parser
+from pheme.util.HL7_segment_parser import Parser
+from pheme.util.tests.test_HL7_segment_parser import HL7TestFile
+from pheme.util.tests.test_HL7_segment_parser import MESSAGES, feed
+
+
+def stub_module(name, **attributes):
+    """Returns a module named name holding attributes"""
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+
+STUBS = {
+    'psycopg2': stub_module('psycopg2', connect=None),
+    'sqlalchemy': stub_module('sqlalchemy', create_engine=None),
+    'sqlalchemy.orm': stub_module('sqlalchemy.orm', sessionmaker=None),
+}
+STUBBED = []
+for name in sorted(STUBS):
+    try:
+        __import__(name)
+    except ImportError:
+        sys.modules[name] = STUBS[name]
+        STUBBED.append(name)
+try:
+    from pheme.util import pg_copy
+finally:
+    for name in STUBBED:
+        del sys.modules[name]
+
+
+class StubCursor(object):
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def copy_expert(self, sql, fileobj):
+        self.calls.append(('copy', sql, fileobj.read()))
+
+    def close(self):
+        pass
+
+
+class StubConnection(object):
+    """Records the COPY, commit, rollback and close calls made"""
+
+    def __init__(self):
+        self.calls = []
+
+    def cursor(self):
+        return StubCursor(self.calls)
+
+    def commit(self):
+        self.calls.append(('commit',))
+
+    def rollback(self):
+        self.calls.append(('rollback',))
+
+    def close(self):
+        self.calls.append(('close',))
+
+
+class TestCopyStream(HL7TestFile):
+
+    def setUp(self):
+        super(TestCopyStream, self).setUp()
+        self.connections = []
+
+        def connect(**params):
+            self.connections.append(StubConnection())
+            return self.connections[-1]
+
+        self.patch(pg_copy.psycopg2, 'connect', connect)
+        self.patch(pg_copy, 'db_params', lambda section: {})
+        # a batch of two 'ED\n' / '4W\n' rows
+        self.patch(HL7_segment_parser, 'COPY_BATCH_SIZE', 6)
+
+    def patch(self, module, name, value):
+        """Replace module.name with value for the test"""
+        self.addCleanup(setattr, module, name, getattr(module, name))
+        setattr(module, name, value)
+
+    def copy_parser(self, *filenames):
+        parser = Parser()
+        parser.processArgs(['--copy', 'warehouse', '-q', 'PV1:3:visits'] +
+                           list(filenames))
+        return parser
+
+    def test_write(self):
+        stream = pg_copy.CopyStream('warehouse', 'public.visits')
+        stream.write('ED\n')
+        stream.write('')
+        stream.flush()
+        stream.close()
+        self.assertEqual(self.connections[0].calls,
+                         [('copy', 'COPY public.visits FROM STDIN', 'ED\n'),
+                          ('commit',), ('commit',), ('close',)])
+
+    def test_batches(self):
+        parser = self.copy_parser(
+            self.create_test_file(feed(messages=MESSAGES * 5)))
+        parser.parse()
+        self.assertEqual(len(self.connections), 1)
+        calls = self.connections[0].calls
+        self.assertEqual(
+            calls[:10], [('copy', 'COPY visits FROM STDIN', 'ED\n4W\n'),
+                         ('commit',)] * 5)
+        self.assertEqual(len([call for call in calls if call[0] == 'copy']),
+                         5)
+        self.assertEqual(calls[-1], ('close',))
+
+    def test_rollback(self):
+        first = self.create_test_file(feed(messages=MESSAGES + MESSAGES[:1]))
+        second = self.create_test_file(feed())
+        parser = self.copy_parser(first, second)
+        process = parser.process
+
+        def failing(writers, counts, filename, *args):
+            if filename == second:
+                raise IOError("unreadable")
+            return process(writers, counts, filename, *args)
+
+        parser.process = failing
+        self.assertRaises(IOError, parser.parse)
+        # the first batch stays committed, the pending 'ED' row is
+        # dropped and nothing more is committed
+        self.assertEqual(self.connections[0].calls,
+                         [('copy', 'COPY visits FROM STDIN', 'ED\n4W\n'),
+                          ('commit',), ('rollback',), ('close',)])
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -31,6 +31,9 @@ setup(name='pheme.util',
       entry_points=("""
                     [console_scripts]
                     HL7_segment_parser=pheme.util.HL7_segment_parser:main
+                    HL7_benchmark=pheme.util.hl7_benchmark:benchmark
+                    HL7_mllp_listener=pheme.util.mllp:main
+                    HL7_store=pheme.util.hl7_store:main
                     configvar=pheme.util.config:configvar
                     """),
 )